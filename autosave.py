@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+from PyQt6.QtCore import *
+
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+
+from classes import Stroke, Square, FreeText, Line
+from lazy import lazy_import
+pymupdf = lazy_import("pymupdf")
+
+AUTOSAVE_DELAY = 2000 # Milliseconds without edits after which the changes are saved
+
+def annotation_record(object) -> tuple | None:
+    # Plain copy of everything written about an annotation, taken on the UI thread so the worker never
+    # sees an annotation change under it, and so it can be pickled to the worker
+    match object:
+        case Stroke():
+            return ("Ink", str(object.id), object.points.copy(), [c / 255 for c in object.color],
+                    object.width, object.opacity, object.highlight)
+        case Square():
+            rect = (*object.pos, object.pos[0] + object.size[0], object.pos[1] + object.size[1])
+            return ("Square", str(object.id), rect, [c / 255 for c in object.border_color],
+                    [c / 255 for c in object.fill_color], object.border_width)
+        case FreeText():
+            rect = (*object.pos, object.pos[0] + object.size[0], object.pos[1] + object.size[1])
+            return ("FreeText", str(object.id), rect, object.text, [c / 255 for c in object.color], object.opacity)
+        case Line():
+            return ("Line", str(object.id), tuple(object.p1), tuple(object.p2), [c / 255 for c in object.color],
+                    object.width, object.opacity)
+    return None
+
+def write_annotation(doc: pymupdf.Document, page: pymupdf.Page, record: tuple):
+    match record:
+        case ("Ink", obj_id, points, color, width, opacity, highlight):
+            annot = page.add_ink_annot([points.tolist()])
+            annot.set_border(width=width)
+            annot.set_colors(stroke=color)
+            annot.set_opacity(opacity)
+            annot.update()
+            if highlight:
+                annot.update(fill_color=color)
+        case ("Square", obj_id, rect, border_color, fill_color, border_width):
+            annot = page.add_rect_annot(rect)
+            annot.set_colors(stroke=border_color, fill=fill_color)
+            annot.set_border(width=border_width)
+            annot.update()
+        case ("FreeText", obj_id, rect, text, color, opacity):
+            annot = page.add_freetext_annot(rect, text, text_color=color)
+            annot.set_opacity(opacity)
+            annot.update()
+        case ("Line", obj_id, p1, p2, color, width, opacity):
+            annot = page.add_line_annot(p1, p2)
+            annot.set_border(width=width)
+            annot.set_colors(stroke=color)
+            annot.set_opacity(opacity)
+            annot.update()
+        case _:
+            return
+
+    # Keep the id stable so the next save can find this annotation again
+    doc.xref_set_key(annot.xref, "NM", pymupdf.get_pdf_str(obj_id))
+
+def write(source: str, filename: str, temp_filename: str, renamed: list[tuple[int, str]],
+          changes: dict[int, tuple[set[str], list[tuple]]]) -> bool:
+    # Runs in the worker process. Saves source with the changes as filename, and returns whether temp_filename
+    # was written instead, to be swapped in. Saving in place appends only the changed objects to the document,
+    # so it costs the same however large the document is; the reader and renderer keep reading the objects
+    # that were there before, which an incremental save leaves untouched. Documents that cannot be saved
+    # incrementally, and saves to another file, are written in full to temp_filename.
+    in_place = source == filename
+    if not in_place:
+        shutil.copyfile(source, temp_filename)
+    doc = pymupdf.open(source if in_place else temp_filename)
+
+    # Ids that the reader gave to annotations which had none, or a duplicate one
+    for xref, obj_id in renamed:
+        doc.xref_set_key(xref, "NM", pymupdf.get_pdf_str(obj_id))
+
+    for page_num, (delete, records) in changes.items():
+        page = doc[page_num]
+
+        # Updated annotations are replaced, keeping their id
+        xrefs = {obj_id: xref for xref, _, obj_id in page.annot_xrefs()}
+        for obj_id in delete:
+            if obj_id in xrefs:
+                page.delete_annot(page.load_annot(xrefs[obj_id]))
+
+        for record in records:
+            write_annotation(doc, page, record)
+
+    if doc.can_save_incrementally():
+        written = source if in_place else temp_filename
+        doc.save(written, incremental=True, encryption=pymupdf.PDF_ENCRYPT_KEEP)
+        doc.close()
+    else:
+        written = temp_filename
+        doc.save(temp_filename + ".full", garbage=1, deflate=True)
+        doc.close()
+        os.replace(temp_filename + ".full", temp_filename)
+
+    # On disk before the save counts as done, or before it replaces the document
+    with open(written, "rb+") as file:
+        os.fsync(file.fileno())
+    return written == temp_filename
+
+class Autosaver(QObject):
+    # Saves the changed pages in a worker process. The UI thread only copies the changed annotations, and reopens
+    # the document when the worker is done. Saves asked for while one runs are coalesced into a single
+    # save after it, which also covers every edit made in the meantime.
+    saving = pyqtSignal(int) # Number of pages that are being saved
+    saved = pyqtSignal(str) # Filename
+    failed = pyqtSignal(str) # Error message
+    finished = pyqtSignal(object) # Internal, carries finished saves from the executor back to the UI thread
+
+    def __init__(self, reader, store, renderer=None, delay: int = AUTOSAVE_DELAY):
+        super().__init__()
+
+        self.reader = reader
+        self.store = store
+        self.renderer = renderer # Has the document open, so it is stopped while a rewritten document is swapped in
+
+        self.executor: ProcessPoolExecutor | None = None # Started by the first save
+        self.future: Future | None = None
+        self.running: dict | None = None # Snapshot the running save writes
+        self.requested = False # A save was asked for while one was running
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.save)
+
+        self.finished.connect(self.finish)
+
+    @property
+    def busy(self) -> bool:
+        return self.future is not None
+
+    def schedule(self):
+        # Called after each edit, saves once edits pause for the delay
+        self.timer.start()
+
+    def snapshot(self, filename: str) -> dict | None:
+        # Changed pages, and what the annotations on them are when the save is started
+        in_place = filename == self.reader.filename
+        if len(self.store.dirty) == 0 and in_place:
+            return None
+
+        changes = {}
+        written = {}
+        for page_num in self.store.dirty:
+            added, deleted, updated = self.store.changes(page_num)
+            records = [annotation_record(self.store.get(page_num, obj_id)) for obj_id in added | updated]
+            changes[page_num] = (deleted | updated, [record for record in records if record is not None])
+            written[page_num] = (self.store.saved.get(page_num, set()) - deleted) | added
+
+        # An incremental save that fails is cut back to the size the document had
+        size = os.path.getsize(filename) if in_place else None
+        return {"filename": filename, "temp": filename + ".tmp", "in_place": in_place, "size": size, "changes": changes,
+                "written": written, "version": self.store.version, "renamed": list(self.reader.renamed)}
+
+    def save(self, filename: str | None = None):
+        self.timer.stop()
+        if filename is None:
+            filename = self.reader.filename
+
+        if self.busy:
+            if filename == self.reader.filename:
+                self.requested = True
+                return
+            self.wait()
+
+        snapshot = self.snapshot(filename)
+        if snapshot is None:
+            return
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(1)
+        try:
+            future = self.executor.submit(write, self.reader.filename, filename, snapshot["temp"], snapshot["renamed"],
+                                          snapshot["changes"])
+        except BrokenProcessPool as error:
+            # The worker died while idle. This save fails and its changes stay unsaved, the next one runs.
+            self.restart()
+            self.failed.emit(f"{type(error).__name__}: {error}")
+            return
+
+        self.saving.emit(len(snapshot["changes"]))
+        self.running = snapshot
+        self.future = future
+        self.future.add_done_callback(self.finished.emit)
+
+    def finish(self, future: Future):
+        # The finished signal of a save that wait() already handled arrives late
+        if future is not self.future:
+            return
+
+        snapshot = self.running
+        self.future = None
+        self.running = None
+
+        try:
+            error = future.exception()
+            if error is not None:
+                raise error
+            rewritten = future.result()
+            if snapshot["in_place"]:
+                self.reopen(snapshot["temp"] if rewritten else None, len(snapshot["renamed"]))
+                for page_num, obj_ids in snapshot["written"].items():
+                    self.store.mark_written(page_num, obj_ids, snapshot["version"])
+                    self.reader.objects.pop(page_num, None) # Parsed before the save, so it is out of date
+            else:
+                os.replace(snapshot["temp"], snapshot["filename"])
+        except Exception as error:
+            # The document is left as it was, and the changes stay unsaved
+            if isinstance(error, BrokenProcessPool):
+                self.restart()
+            if os.path.isfile(snapshot["temp"]):
+                os.remove(snapshot["temp"])
+            if snapshot["in_place"] and future.exception() is not None and os.path.getsize(snapshot["filename"]) > snapshot["size"]:
+                with open(snapshot["filename"], "rb+") as file:
+                    file.truncate(snapshot["size"])
+            self.failed.emit(f"{type(error).__name__}: {error}")
+        else:
+            self.saved.emit(snapshot["filename"])
+
+        if self.requested:
+            self.requested = False
+            self.save()
+
+    def restart(self):
+        # A worker that died, such as one killed for using too much memory, breaks the executor for good
+        self.executor.shutdown(wait=False)
+        self.executor = ProcessPoolExecutor(1)
+
+    def reopen(self, filename: str | None, saved: int):
+        # Read the saved document from now on. A rewritten one is swapped in while nothing has the document open,
+        # since an open file cannot be replaced on every platform.
+        if filename is None:
+            self.reader.replace(None, saved)
+            return
+
+        if self.renderer is not None:
+            self.renderer.suspend()
+        try:
+            self.reader.replace(filename, saved)
+        finally:
+            if self.renderer is not None:
+                self.renderer.resume()
+
+    def wait(self):
+        # Block until the running save, and any save requested while it ran, is done
+        while self.future is not None:
+            future = self.future
+            future.exception()
+            self.finish(future)
+
+    def flush(self):
+        # Save everything now and wait for it, as when the window closes
+        self.save()
+        self.wait()
+
+    def close(self):
+        self.timer.stop()
+        if self.executor is not None:
+            self.executor.shutdown()
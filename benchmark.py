@@ -0,0 +1,304 @@
+import os
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen") # Must be set before Qt is loaded
+
+from PyQt6.QtWidgets import *
+from PyQt6.QtGui import *
+from PyQt6.QtCore import *
+import sys
+import json
+import random
+import argparse
+import platform
+import tempfile
+import shutil
+import subprocess
+
+from time import perf_counter, sleep
+from statistics import median
+
+import pymupdf
+
+PAGE_SIZE = 595, 842 # A4 in points
+TOLERANCE = 0.2 # Fraction a benchmark may be slower than the baseline before it counts as a regression
+TOP_IMPORTS = 15 # Packages listed in the import time breakdown
+ENGINES = ["tiles", "scene"] # Rendering engines, see main.ENGINES
+DRAG_FRAMES = 60 # Frames in the selection drag benchmark
+LASSO_STEPS = 40 # Lasso points along each side of the lassoed area
+
+def make_document(filename: str, pages: int, strokes: int, points: int, seed: int = 0, page_size: tuple = PAGE_SIZE):
+    # Synthetic document: a few lines of text per page, covered in random-walk ink strokes
+    random.seed(seed)
+    doc = pymupdf.open()
+    for page_num in range(pages):
+        page = doc.new_page(width=page_size[0], height=page_size[1])
+        for line in range(40):
+            page.insert_text((50, 60 + line * 18), f"Page {page_num + 1}, line {line + 1}: the quick brown fox jumps over the lazy dog", fontsize=11)
+
+        for _ in range(strokes):
+            x, y = random.uniform(20, page_size[0] - 20), random.uniform(20, page_size[1] - 20)
+            path = []
+            for _ in range(points):
+                x = min(page_size[0], max(0, x + random.uniform(-3, 3)))
+                y = min(page_size[1], max(0, y + random.uniform(-3, 3)))
+                path.append((x, y))
+
+            annot = page.add_ink_annot([path])
+            annot.set_border(width=1)
+            annot.set_colors(stroke=(0, 0, 0))
+            annot.update()
+
+    doc.save(filename)
+    doc.close()
+
+def measure(function, repeat: int, setup=None) -> dict:
+    # Run function repeat times, calling setup before each run outside of the timing
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        function()
+        runs.append(perf_counter() - start)
+
+    return {"median": median(runs), "min": min(runs), "runs": runs}
+
+def import_times(module: str = "main") -> dict[str, float]:
+    # Seconds spent importing each top-level package when module is imported in a fresh interpreter,
+    # as reported by python -X importtime. The module itself is under its own name, with the total under "total".
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), env=os.environ).stderr
+
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        times[package] = times.get(package, 0) + int(own) / 1e6
+        if name.strip() == module:
+            times["total"] = int(cumulative) / 1e6
+    return times
+
+def wait(app: QApplication, condition, timeout: float = 30):
+    # Process events until condition() holds
+    end = perf_counter() + timeout
+    while not condition() and perf_counter() < end:
+        app.processEvents()
+        sleep(0.001)
+
+def window_benchmarks(app: QApplication, filename: str, args, engine: str) -> dict:
+    # Open, render, edit and save the document in a window that uses the given rendering engine
+    import main
+
+    results = {}
+    window = None
+    def open_window():
+        nonlocal window
+        window = main.Window(filename, engine)
+        wait(app, lambda: window.gv is not None and len(window.gv.pages) > 0) # Opens the document and paints it
+    def close_window():
+        nonlocal window
+        if window is not None:
+            close(window)
+            window = None
+    results["open"] = measure(open_window, args.repeat, close_window)
+
+    gv = window.gv
+    page = gv.pages[0]
+    origin = gv.page_origin(page) - gv.drawRect.topLeft().toPointF()
+
+    def refresh():
+        gv.refresh()
+        gv.viewport().repaint()
+    results["refresh"] = measure(refresh, args.repeat)
+
+    def erase():
+        # Sweep the eraser across the first page in horizontal lines, then remove the erased strokes
+        gv.previous_point = None
+        for y in range(0, int(page.size.height() * gv.zoom), 40):
+            gv.eraseEvent(origin + QPointF(0, y))
+            gv.eraseEvent(origin + QPointF(page.size.width() * gv.zoom, y + 20))
+            gv.previous_point = None
+        gv.tabletReleaseEvent(QPointF())
+        gv.viewport().repaint()
+    results["erase"] = measure(erase, args.repeat, lambda: (gv.undo(), gv.viewport().repaint()))
+    gv.undo()
+
+    zooms = iter([1.6, 1, 2.4, 1, 3.2, 1] * args.repeat)
+    def pinch():
+        gv.zoom = next(zooms)
+        gv.rescale()
+        wait(app, lambda: gv.rescale_future is None)
+        gv.viewport().repaint()
+    results["pinch"] = measure(pinch, args.repeat * 2)
+
+    def lasso():
+        # Lasso the top half of the first page
+        width, height = page.size.width() * gv.zoom, page.size.height() * gv.zoom / 2
+        corners = [QPointF(1, 1), QPointF(width - 1, 1), QPointF(width - 1, height), QPointF(1, height)]
+        gv.lassoPressEvent(origin + corners[0])
+        for start, end in zip(corners, corners[1:] + corners[:1]):
+            for i in range(1, LASSO_STEPS + 1):
+                gv.lassoMoveEvent(origin + start + (end - start) * i / LASSO_STEPS)
+        gv.lassoReleaseEvent(QPointF())
+        gv.viewport().repaint()
+    def drag():
+        # Frames of dragging the selection, each one repainted
+        center = gv.selection_rect().center()
+        gv.lassoPressEvent(center)
+        for i in range(1, DRAG_FRAMES + 1):
+            gv.lassoMoveEvent(center + QPointF(i, i / 2))
+            gv.viewport().repaint()
+        gv.lassoReleaseEvent(QPointF())
+    def select():
+        gv.undo() # The previous commit, so the strokes are back where they were
+        lasso()
+    gv.set_tool("lasso")
+    results["lasso select"] = measure(lasso, args.repeat, gv.clear_selection)
+    results["drag selection"] = measure(drag, args.repeat)
+    results["commit selection"] = measure(lambda: (gv.clear_selection(), gv.viewport().repaint()), args.repeat,
+                                          lambda: (select(), drag()))
+    gv.undo()
+    gv.set_tool("pen")
+
+    def draw():
+        # Draw a stroke so there is something to save
+        gv.tabletPressEvent(origin + QPointF(100, 100))
+        for i in range(1, 50):
+            gv.tabletMoveEvent(origin + QPointF(100 + i * 4, 100 + (i % 7) * 3))
+        gv.tabletReleaseEvent(QPointF())
+    def save():
+        window.save()
+        window.autosaver.wait()
+    results["save"] = measure(save, args.repeat, draw)
+    # Only the part of a save that blocks the UI thread
+    results["save blocking"] = measure(window.save, args.repeat, lambda: (window.autosaver.wait(), draw()))
+    window.autosaver.wait()
+
+    close(window)
+    return results
+
+def run(args) -> dict:
+    # Imports are timed in fresh interpreters, before this one has loaded anything
+    imports = [import_times() for _ in range(args.repeat)]
+    totals = [times["total"] for times in imports]
+
+    app = QApplication.instance() or QApplication(sys.argv)
+
+    import sidecar
+    from reader import Reader
+
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, "benchmark.pdf")
+    make_document(filename, args.pages, args.strokes, args.points, args.seed, args.page_size)
+
+    # Parse the document every time, except in the reopen benchmark, which uses a cache in the temporary directory
+    sidecar.ENABLED = False
+    sidecar.DIRECTORY = directory
+
+    results = {"import": {"median": median(totals), "min": min(totals), "runs": totals}}
+
+    def load():
+        reader = Reader(filename)
+        for page_num in range(len(reader)):
+            reader.read_page(page_num)
+        reader.close()
+    results["load"] = measure(load, args.repeat)
+
+    def load_parallel():
+        reader = Reader(filename)
+        reader.read_pages()
+        reader.close()
+    results["load parallel"] = measure(load_parallel, args.repeat)
+
+    reader = Reader(filename, use_cache=False)
+    reader.write_cache()
+    reader.close()
+    def reopen():
+        reader = Reader(filename, use_cache=True)
+        for page_num in range(len(reader)):
+            reader.read_page(page_num)
+        reader.close()
+    results["reopen"] = measure(reopen, args.repeat)
+
+    engines = ENGINES if args.engine == "both" else [args.engine]
+    for engine in engines:
+        # Results of the tile engine, or of the only engine run, under the plain names
+        suffix = "" if engine == "tiles" or len(engines) == 1 else f" [{engine}]"
+        results.update({name + suffix: result for name, result in window_benchmarks(app, filename, args, engine).items()})
+
+    shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        "config": {"pages": args.pages, "strokes": args.strokes, "points": args.points, "page_size": list(args.page_size),
+                   "repeat": args.repeat, "seed": args.seed, "engine": args.engine},
+        "environment": {"python": platform.python_version(), "qt": QT_VERSION_STR,
+                        "pymupdf": pymupdf.VersionBind, "platform": platform.platform()},
+        "results": results,
+        # Import time of each package in the last run, slowest first
+        "imports": dict(sorted(imports[-1].items(), key=lambda item: -item[1])[:TOP_IMPORTS]),
+    }
+
+def close(window):
+    # Close without the save that Window.closeEvent does
+    window.autosaver.close()
+    window.gv.shutdown()
+    window.renderer.close()
+    window.reader.close()
+    window.hide()
+    window.deleteLater()
+
+def page_size(text: str) -> tuple[float, float]:
+    width, height = text.lower().split("x")
+    return float(width), float(height)
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    # Names of the benchmarks whose median is slower than the baseline by more than tolerance
+    regressions = []
+    print(f"{'benchmark':<10} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, result in report["results"].items():
+        if name not in baseline["results"]:
+            continue
+
+        before = baseline["results"][name]["median"]
+        after = result["median"]
+        change = after / before - 1 if before > 0 else 0
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print(f"{name:<10} {before * 1000:>8.1f}ms {after * 1000:>8.1f}ms {change:>+7.0%}{flag}")
+
+    if baseline.get("config") != report["config"]:
+        print("Warning: the baseline was measured with a different configuration")
+
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time loading, rendering, erasing, zooming and saving on a synthetic document")
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--strokes", type=int, default=300, help="strokes per page")
+    parser.add_argument("--points", type=int, default=40, help="points per stroke")
+    parser.add_argument("--page-size", type=page_size, default=PAGE_SIZE, help="page size in points, as WIDTHxHEIGHT")
+    parser.add_argument("--engine", choices=ENGINES + ["both"], default="both",
+                        help="rendering engine, or both to measure each of them on the same document")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if compare(report, baseline, args.tolerance):
+            sys.exit(1)
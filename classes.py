@@ -1,27 +1,46 @@
+from __future__ import annotations
+
 from PyQt6.QtWidgets import *
 from PyQt6.QtGui import *
 from PyQt6.QtCore import *
 
-from pymupdf import Rect, Annot
-import pypdf
-from pypdf.generic import AnnotationBuilder
 from datetime import datetime
+from math import floor, log2, sqrt
 from uuid import uuid4
 
+from lazy import lazy_import
+np = lazy_import("numpy")
+pymupdf = lazy_import("pymupdf")
+
+SIMPLIFY_TOLERANCE = 0.25 # Distance simplified strokes may deviate from their samples, as a fraction of the pen width
+LOD_TOLERANCE = 0.25 # Page points the first level of detail may deviate from a stroke, each further level doubles it
+LOD_LEVELS = 6 # Levels of detail below the full stroke
+PIXEL_ERROR = 0.5 # Device pixels a stroke may be drawn away from its points
+LOD_MIN_REDUCTION = 0.75 # A level of detail is only built when it has at most this fraction of the stroke's points
+PAINT_MARGIN = 2 # Device pixels that antialiasing, or a cosmetic pen, may paint past a stroke's outline
+
+def lod_level(zoom: float) -> int:
+    # Coarsest level of detail that stays within PIXEL_ERROR at zoom, 0 being every point
+    if zoom * LOD_TOLERANCE > PIXEL_ERROR:
+        return 0
+    return min(LOD_LEVELS, floor(log2(PIXEL_ERROR / (zoom * LOD_TOLERANCE))) + 1)
+
 def rgb_to_hex(rgb: list | tuple):
     return '#%02x%02x%02x' % tuple(rgb)
 
 class Ink:
-    def __init__(self, id: str, points: list, color: tuple, width: int, opacity: float):
+    __slots__ = ("id", "points", "color", "width", "opacity", "highlight")
+
+    def __init__(self, id: str, points: list | np.ndarray, color: tuple, width: int, opacity: float):
         self.id = id
-        self.points = points
+        self.points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
         self.color = [int(x * 255) for x in color]
         self.width = width
         self.opacity = opacity
         self.highlight = (width == 0)
 
 class Square:
-    def __init__(self, id: str, rect: Rect, opacity: float,
+    def __init__(self, id: str, rect: pymupdf.Rect, opacity: float,
                  border_color: tuple, fill_color: tuple, border_width: int):
         self.id = id
         self.pos = [rect.x0, rect.y0]
@@ -188,8 +207,11 @@ def colliderect(start: QPointF, end: QPointF, pos: QPointF) -> bool:
     return True
 
 class Stroke:
+    __slots__ = ("left", "right", "top", "bottom", "width", "id", "highlight", "color", "opacity",
+                 "imported", "_coords", "_count", "_segments", "_paths")
+
     def __init__(self, color: tuple, width: int,
-                 points: list[QPointF] = None, opacity: float = 1,
+                 points: list[QPointF] | np.ndarray = None, opacity: float = 1,
                  highlight: bool = False, imported: bool = False, id: str | None = None):
         self.left = 0
         self.right = 0
@@ -199,7 +221,7 @@ class Stroke:
 
         self.id = id
         if id is None:
-            self.id = uuid4()
+            self.id = str(uuid4())
 
         self.highlight = highlight
         self.color = color
@@ -207,14 +229,63 @@ class Stroke:
 
         self.imported = imported
 
-        self.points: list[QPointF] = []
+        # Coordinates are stored in a contiguous (capacity, 2) float32 array, of which the first _count rows are used
+        self._coords = np.empty((0, 2), dtype=np.float32)
+        self._count = 0
+        self._segments = None
+        self._paths = {}
         if points is not None:
-            for point in points:
-                self.add(point)
+            self.extend(points)
+
+    @property
+    def points(self) -> np.ndarray:
+        # (n, 2) array of x, y coordinates
+        return self._coords[:self._count]
+
+    def extend(self, points: list[QPointF] | np.ndarray):
+        if not isinstance(points, np.ndarray):
+            points = [(point.x(), point.y()) if isinstance(point, (QPoint, QPointF)) else point for point in points]
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        if len(points) == 0:
+            return
+
+        if self._count == 0:
+            # Share the array, it is copied before it is ever appended to
+            self._coords = points
+            self._count = len(points)
+        else:
+            self._coords = np.concatenate((self.points, points))
+            self._count = len(self._coords)
+        self._segments = None
+        self._paths = {}
+
+        # Update bounding box in bulk, the same as calling add() for every point
+        xs, ys = points[:, 0].astype(np.float64), points[:, 1].astype(np.float64)
+        if self.right - self.left == 0:
+            self.left = xs[0]
+            self.top = ys[0]
+            self.right = xs[0] + 5
+            self.bottom = ys[0] + 5 # Default value so that a point can also be erased
+
+        self.left = float(min(self.left, xs.min()))
+        self.right = float(max(self.right, xs.max()))
+        self.top = float(min(self.top, ys.min()))
+        self.bottom = float(max(self.bottom, ys.max()))
 
     def add(self, pos: QPoint | QPointF):
-        self.points.append(QPointF(pos))
-        x, y = pos.x(), pos.y()
+        # Grow the array geometrically so live inking appends in amortised O(1)
+        if self._count == len(self._coords):
+            coords = np.empty((max(16, self._count * 2), 2), dtype=np.float32)
+            coords[:self._count] = self.points
+            self._coords = coords
+
+        self._coords[self._count] = pos.x(), pos.y()
+        self._count += 1
+        self._segments = None
+        self._paths = {}
+
+        # Use the stored (float32) coordinates so add() and extend() give the same bounding box
+        x, y = (float(c) for c in self._coords[self._count - 1])
 
         # Update bounding box
         if self.right - self.left == 0:
@@ -232,10 +303,29 @@ class Stroke:
         elif y > self.bottom:
             self.bottom = y
 
+    def simplify(self, tolerance: float):
+        # Drop points that lie within tolerance of the simplified line, keeping the first and last point
+        points = simplify_points(self.points, tolerance)
+        if len(points) == self._count:
+            return
+
+        self.left = self.right = self.top = self.bottom = 0
+        self._coords = np.empty((0, 2), dtype=np.float32)
+        self._count = 0
+        self.extend(points)
+
     @property
     def rect(self) -> tuple:
         return (self.left, self.top, self.right - self.left, self.bottom - self.top)
 
+    @property
+    def segments(self) -> np.ndarray:
+        # (n - 1, 4) array of x1, y1, x2, y2 for every line segment, rebuilt after points are added
+        if self._segments is None:
+            xy = self.points.astype(np.float64)
+            self._segments = np.concatenate((xy[:-1], xy[1:]), axis=1)
+        return self._segments
+
     def collidepoint(self, pos: QPoint | QPointF) -> bool:
         x, y = pos.x(), pos.y()
 
@@ -246,31 +336,23 @@ class Stroke:
             return False
         
         # Rect collision for all line segments
-        for i in range(len(self.points) - 1):
-            start = self.points[i]
-            end = self.points[i + 1]
-            if colliderect(start, end, pos):
-                break
-        else:
-            return False
-
-        return True
+        return bool(collidepoint_segments(self.segments, x, y).any())
 
-    def collideline(self, line: QLine | QLineF) -> bool:
+    def collideline(self, line: QLine | QLineF, segments: list[int] | None = None) -> bool:
         if type(line) != QLineF:
             line = QLineF(line)
 
         if not intersect_line_rect(line, QRectF(*self.rect)):
             return False
 
-        for i in range(len(self.points) - 1):
-            line2 = QLineF(self.points[i], self.points[i + 1])
-            if intersect_lines(line, line2):
-                return True
-            
-        return False
+        # Only test the given segment indices, e.g. candidates from a spatial index
+        lines = self.segments
+        if segments is not None:
+            lines = lines[segments]
+
+        return bool(intersect_lines_segments(line_array(line), lines).any())
     
-    def colliderect(self, rect: QRect | QRectF) -> bool | list[QLineF]:
+    def colliderect(self, rect: QRect | QRectF) -> bool:
         if self.left > rect.right():
             return False
         if self.right < rect.left():
@@ -279,24 +361,74 @@ class Stroke:
             return False
         if self.bottom < rect.top():
             return False
-        
-        lines = []
-        for i in range(len(self.points) - 1):
-            line = QLineF(self.points[i], self.points[i + 1])
-            if intersect_line_rect(line, rect):
-                lines.append(line)
-        
-        if len(lines) > 0:
-            return lines
-        
-        return False
+        if self._count < 2:
+            return False
+
+        # A stroke inside the rect, or with a segment starting in it, collides without testing the rect's sides
+        left, top, right, bottom = rect.getCoords()
+        if self.left >= left and self.right <= right and self.top >= top and self.bottom <= bottom:
+            return True
+        segments = self.segments
+        x, y = segments[:, 0], segments[:, 1]
+        if ((x >= left) & (x <= right) & (y >= top) & (y <= bottom)).any():
+            return True
+
+        return bool(intersect_rect_segments(segments, rect).any())
+
+    def intersects_painted(self, rect: QRect | QRectF, margin: float = 0, width: float | None = None) -> bool:
+        # Whether drawing the stroke paints inside rect, for culling what is drawn. colliderect() only tests the
+        # centre line, but the pen reaches half its width past it, and its square caps further along the diagonal.
+        # Highlights are filled, so they also paint a rect that lies inside them. margin pads the pen in page
+        # coordinates, e.g. for antialiasing, and width overrides the pen width, as the erase preview does.
+        if width is None:
+            width = self.width
+        pad = width * sqrt(2) / 2 + margin
+        rect = QRectF(rect).adjusted(-pad, -pad, pad, pad)
+        if self.colliderect(rect):
+            return True
+        if not self.highlight or self._count < 3:
+            return False
+        if self.left > rect.right() or self.right < rect.left() or self.top > rect.bottom() or self.bottom < rect.top():
+            return False
+
+        # The edge closing the polygon, and a rect inside it, which then crosses none of its edges
+        segments = self.segments
+        closing = np.concatenate((segments[-1, 2:], segments[0, :2]))[None]
+        if intersect_rect_segments(closing, rect).any():
+            return True
+        centre = rect.center()
+        return bool(points_in_polygon(np.array([(centre.x(), centre.y())]), self.points)[0])
 
     def denormalise(self, point: QPoint | QPointF, size: QSize | QSizeF) -> QPointF:
         return QPointF(point.x() * size.width(), point.y() * size.height())
 
+    def path(self, level: int = 0) -> QPainterPath | QPolygonF:
+        # Outline in page coordinates at a level of detail, built the first time it is drawn and dropped when
+        # points are added. Highlights are filled polygons, other strokes open paths.
+        path = self._paths.get(level)
+        if path is not None:
+            return path
+
+        points = self.points
+        if level > 0:
+            # A level that hardly drops any points is not worth building, all of them are drawn instead
+            points = decimate_points(points, LOD_TOLERANCE * 2 ** (level - 1))
+            if len(points) > LOD_MIN_REDUCTION * self._count:
+                path = self._paths[level] = self.path(0)
+                return path
+
+        polygon = QPolygonF([QPointF(x, y) for x, y in points.astype(np.float64).tolist()])
+        if self.highlight:
+            path = polygon
+        else:
+            path = QPainterPath()
+            path.addPolygon(polygon)
+        self._paths[level] = path
+        return path
+
     def draw(self, painter: QPainter,
              width: int | None = None, opacity: float | None = None,
-             zoom: float = 1, lines: list[QLineF] | None = None):
+             zoom: float = 1, color: tuple | None = None):
         
         if width is None:
             width = self.width
@@ -304,36 +436,31 @@ class Stroke:
         if opacity is None:
             opacity = self.opacity
 
-        color = QColor(*self.color[:3], int(opacity * 255))
-        painter.setPen(QPen(color, width * zoom, Qt.PenStyle.SolidLine))
+        if color is None:
+            color = self.color
+
+        if self._count == 0:
+            return
+
+        # The cached path is drawn at any zoom by scaling the painter, which scales the pen width too.
+        # Zoomed out, a coarser level of detail looks the same, since its error is under a device pixel.
+        path = self.path(lod_level(zoom))
+        color = QColor(*color[:3], int(opacity * 255))
+        painter.save()
+        painter.scale(zoom, zoom)
+        painter.setPen(QPen(color, width, Qt.PenStyle.SolidLine))
 
         # Highlight stroke
         if self.highlight:
             painter.setBrush(QBrush(color))
-            points = [point * zoom for point in self.points]
-            polygon = QPolygonF(points)
-            painter.drawPolygon(polygon, Qt.FillRule.OddEvenFill)
+            painter.drawPolygon(path, Qt.FillRule.OddEvenFill)
+            painter.restore()
             return
 
         # Normal stroke
-        # if lines is None:
-        #     lines = []
-        #     for i in range(len(self.points) - 1):
-        #         p1 = self.points[i] * zoom
-        #         p2 = self.points[i + 1] * zoom
-        #         lines.append(QLineF(p1, p2))
-        # else:
-        #     for line in lines:
-        #         line.setP1(line.p1() * zoom)
-        #         line.setP2(line.p2() * zoom)
-        # painter.drawLines(lines)
-
         painter.setBrush(QBrush(QColor(0, 0, 0, 0)))
-        path = QPainterPath(self.points[0] * zoom)
-        for point in self.points[1:]:
-            path.lineTo(point * zoom)
-
         painter.drawPath(path)
+        painter.restore()
 
     def export(self):
         ...
@@ -465,7 +592,153 @@ def intersect_line_rect(line: QLineF, rect: QRectF):
 
     return False
 
-if __name__ == "__main__":
-    s = Stroke((0, 0, 0), 1, [QPointF(0, 0), QPointF(50, 50)])
-    rect = QRectF(40, 0, 30, 30)
-    print(s.colliderect(rect))
\ No newline at end of file
+# Batched versions of the collision tests above, testing many line segments in one NumPy call.
+# Segments are (..., 4) float64 arrays of x1, y1, x2, y2 and give exactly the same results as the scalar functions.
+
+def line_array(line: QLine | QLineF) -> np.ndarray:
+    return np.array([line.x1(), line.y1(), line.x2(), line.y2()], dtype=np.float64)
+
+def intersect_lines_segments(lines1: np.ndarray, lines2: np.ndarray) -> np.ndarray:
+    # Broadcasting intersect_lines(): either argument can be a single line or an array of lines
+    x0, y0, x1, y1 = np.moveaxis(np.asarray(lines1, dtype=np.float64), -1, 0)
+    x2, y2, x3, y3 = np.moveaxis(np.asarray(lines2, dtype=np.float64), -1, 0)
+
+    s1_x = x1 - x0
+    s1_y = y1 - y0
+    s2_x = x3 - x2
+    s2_y = y3 - y2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        d = -s2_x * s1_y + s1_x * s2_y
+        s = (-s1_y * (x0 - x2) + s1_x * (y0 - y2)) / d
+        t = ( s2_x * (y0 - y2) - s2_y * (x0 - x2)) / d
+
+        # Same (collinearity) checks as intersect_lines() when lines are parallel
+        parallel = np.where((x1 == 0) | (y1 == 0), x2 * y1 != y2 * x1,
+                   np.where(x2 == 0, y1 != 0, y1 / x1 == y2 / x2))
+
+    crossing = (s >= 0) & (s <= 1) & (t >= 0) & (t <= 1)
+    return np.where(d == 0, parallel, crossing)
+
+def intersect_rect_segments(lines: np.ndarray, rect: QRect | QRectF) -> np.ndarray:
+    # intersect_line_rect() for an (n, 4) array of lines against one rect
+    x1, y1, x2, y2 = np.asarray(lines, dtype=np.float64).T
+    left, top, right, bottom = rect.getCoords()
+
+    outside = (((x1 < left) & (x2 < left)) | ((x1 > right) & (x2 > right)) |
+               ((y1 < top) & (y2 < top)) | ((y1 > bottom) & (y2 > bottom)))
+    inside = ((x1 >= left) & (x1 <= right) & (y1 >= top) & (y1 <= bottom) &
+              (x2 >= left) & (x2 <= right) & (y2 >= top) & (y2 <= bottom))
+
+    sides = np.array([[left, top, right, top], [right, top, right, bottom],
+                      [right, bottom, left, bottom], [left, bottom, left, top]], dtype=np.float64)
+    crossing = intersect_lines_segments(lines[:, None, :], sides[None, :, :]).any(axis=1)
+
+    return ~outside & (inside | crossing)
+
+def simplify_points(points: np.ndarray, tolerance: float) -> np.ndarray:
+    # Ramer-Douglas-Peucker, measuring the distance to each segment rather than to its infinite line,
+    # so that points where a stroke doubles back are kept
+    count = len(points)
+    if count < 3 or tolerance < 0:
+        return points
+
+    xy = np.asarray(points, dtype=np.float64)
+    xs, ys = xy.T
+    rows = xy.tolist()
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    tolerance *= tolerance
+
+    spans = [(0, count - 1)]
+    while spans:
+        start, end = spans.pop()
+        if end - start < 2:
+            continue
+
+        ax, ay = rows[start]
+        dx, dy = rows[end][0] - ax, rows[end][1] - ay
+        length = dx * dx + dy * dy
+
+        # Squared distance of the furthest inner point; long spans in bulk, short ones without the overhead of NumPy
+        if end - start > 64:
+            px, py = xs[start + 1:end] - ax, ys[start + 1:end] - ay
+            if length > 0:
+                t = np.clip((px * dx + py * dy) / length, 0, 1)
+                px, py = px - t * dx, py - t * dy
+            distances = px * px + py * py
+            i = int(distances.argmax())
+            distance, mid = distances[i], start + 1 + i
+        else:
+            distance, mid = -1, start
+            for i in range(start + 1, end):
+                px, py = rows[i][0] - ax, rows[i][1] - ay
+                if length > 0:
+                    t = min(1, max(0, (px * dx + py * dy) / length))
+                    px, py = px - t * dx, py - t * dy
+                if px * px + py * py > distance:
+                    distance, mid = px * px + py * py, i
+
+        if distance > tolerance:
+            keep[mid] = True
+            spans.append((start, mid))
+            spans.append((mid, end))
+
+    return points[keep]
+
+def decimate_points(points: np.ndarray, tolerance: float) -> np.ndarray:
+    # Keep the first of each run of points in the same grid cell, and the last point. Cells have a diagonal of
+    # tolerance, so every dropped point is within tolerance of a kept one. Cruder than simplify_points(),
+    # but linear and vectorised, so it is cheap enough to run while drawing.
+    if len(points) < 3:
+        return points
+
+    cells = np.floor(points / (tolerance / np.sqrt(2))).astype(np.int64)
+    keep = np.empty(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    keep[1:-1] = (cells[1:-1] != cells[:-2]).any(axis=1)
+    return points[keep]
+
+def points_in_polygon(points: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    # Even-odd test of (n, 2) points against a closed (m, 2) polygon, one edge at a time over all points
+    x, y = np.asarray(points, dtype=np.float64).T
+    inside = np.zeros(len(x), dtype=bool)
+    vertices = np.asarray(polygon, dtype=np.float64).tolist()
+    for (x1, y1), (x2, y2) in zip(vertices, vertices[1:] + vertices[:1]):
+        if y1 == y2:
+            continue # A horizontal edge never crosses the ray
+
+        crossing = (y1 > y) != (y2 > y)
+        inside ^= crossing & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+    return inside
+
+def collidepoint_segments(lines: np.ndarray, x: float, y: float) -> np.ndarray:
+    # colliderect() of a point against the bounding box of each segment
+    x1, y1, x2, y2 = np.asarray(lines, dtype=np.float64).T
+    return ((x >= np.minimum(x1, x2)) & (x <= np.maximum(x1, x2)) &
+            (y >= np.minimum(y1, y2)) & (y <= np.maximum(y1, y2)))
+
+def collideline_strokes(strokes: list[Stroke] | dict[Stroke, list[int]], line: QLine | QLineF) -> list[Stroke]:
+    # Stroke.collideline() for many strokes at once, optionally restricted to candidate segments per stroke
+    if type(line) != QLineF:
+        line = QLineF(line)
+
+    if not isinstance(strokes, dict):
+        strokes = {stroke: None for stroke in strokes}
+
+    owners = []
+    lines = []
+    for stroke, segments in strokes.items():
+        if not intersect_line_rect(line, QRectF(*stroke.rect)):
+            continue
+        segs = stroke.segments if segments is None else stroke.segments[segments]
+        owners.append(stroke)
+        lines.append(segs)
+
+    if len(lines) == 0:
+        return []
+
+    counts = [len(segs) for segs in lines]
+    hits = intersect_lines_segments(line_array(line), np.concatenate(lines))
+    hit_owners = np.unique(np.repeat(np.arange(len(owners)), counts)[hits])
+    return [owners[i] for i in hit_owners]
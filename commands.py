@@ -0,0 +1,101 @@
+from collections import deque
+
+from classes import Stroke
+
+UNDO_MEMORY = 64 * 1024 * 1024 # Bytes of stroke points kept alive by the undo history
+
+class Command:
+    # One user action, as the annotations it added to and removed from pages, in (object, page) pairs.
+    # Annotations are referred to by identity, so applying or reverting only touches those annotations.
+    def __init__(self, added: list[tuple] = (), removed: list[tuple] = ()):
+        self.added = list(added)
+        self.removed = list(removed)
+
+        # Drawing order of the strokes while they are removed, so they are restored where they were
+        self.added_order: dict[Stroke, int] = {}
+        self.removed_order: dict[Stroke, int] = {}
+
+        # Annotations replaced by one with the same id, such as moved or recoloured strokes, as (page, id)
+        self.replaced = {(page.num, str(object.id)) for object, page in self.added} & \
+            {(page.num, str(object.id)) for object, page in self.removed}
+
+        self.size = sum(object.points.nbytes for object, _ in self.added + self.removed if isinstance(object, Stroke))
+
+    def apply(self, area):
+        # Positions given beforehand are kept for strokes that are not in the index, such as selected ones
+        self.removed_order.update(area.remove_objects(self.removed))
+        area.add_objects(self.added, self.added_order)
+        self.modify(area)
+
+    def revert(self, area):
+        self.added_order = area.remove_objects(self.added)
+        area.add_objects(self.removed, self.removed_order)
+        self.modify(area)
+
+    def modify(self, area):
+        # A replaced annotation is written again in place, whichever version of it the file has
+        for page_num, obj_id in self.replaced:
+            area.store.modify(page_num, obj_id)
+
+    def pages(self) -> set[int]:
+        return {page.num for _, page in self.added + self.removed}
+
+class CommandStack:
+    # Undo and redo history, trimmed from the oldest command to stay within limit commands and max_bytes
+    def __init__(self, area, limit: int, max_bytes: int = UNDO_MEMORY):
+        self.area = area
+        self.limit = limit
+        self.max_bytes = max_bytes
+
+        self.undo_stack: deque[Command] = deque()
+        self.redo_stack: list[Command] = []
+        self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.undo_stack)
+
+    def push(self, command: Command, apply: bool = False):
+        # Commands that were carried out while the user acted, such as a drawn stroke, are pushed without applying them
+        if apply:
+            command.apply(self.area)
+
+        self.undo_stack.append(command)
+        self.bytes += command.size
+        for undone in self.redo_stack:
+            self.bytes -= undone.size
+        self.redo_stack.clear()
+
+        while len(self.undo_stack) > self.limit or (self.bytes > self.max_bytes and len(self.undo_stack) > 1):
+            self.bytes -= self.undo_stack.popleft().size
+
+    def undo(self) -> Command | None:
+        if len(self.undo_stack) == 0:
+            return None
+
+        command = self.undo_stack.pop()
+        command.revert(self.area)
+        self.redo_stack.append(command)
+        return command
+
+    def redo(self) -> Command | None:
+        if len(self.redo_stack) == 0:
+            return None
+
+        command = self.redo_stack.pop()
+        command.apply(self.area)
+        self.undo_stack.append(command)
+        return command
+
+    def pages(self) -> set[int]:
+        # Pages the history refers to, which must stay resident so their annotations keep their identity
+        pages = set()
+        for command in self.undo_stack:
+            pages |= command.pages()
+        for command in self.redo_stack:
+            pages |= command.pages()
+        return pages
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.bytes = 0
@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import argparse
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+SHAPE_TYPES = {"Square", "Circle", "Line", "Polygon", "PolyLine"}
+PARQUET_BATCH = 10000 # Annotations per Parquet row group
+DECIMALS = 3 # Decimal places of exported coordinates
+
+def find_pdfs(paths: list[str]) -> list[str]:
+    # PDF files in the given files and directories, recursively, in a stable order
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in sorted(os.walk(path)):
+                files += [os.path.join(directory, name) for name in sorted(names) if name.lower().endswith(".pdf")]
+        else:
+            files.append(path)
+    return files
+
+def export_file(filename: str, simplify: bool, page_workers: int = 1) -> tuple[str, list[dict], int, str | None]:
+    # Runs in a worker process, unless there is a single file, whose pages are then split across page_workers.
+    # Errors are returned rather than raised, so one bad file does not stop the batch.
+    # The files are only read, so the editor's annotation cache is neither used nor written.
+    from reader import Reader
+
+    records = []
+    try:
+        reader = Reader(filename, cache_size=1, simplify=simplify, use_cache=False)
+        try:
+            for page_num, objects in enumerate(reader.read_pages(workers=page_workers)):
+                for object in objects:
+                    points = object.points.astype(float).round(DECIMALS) # Rounded as float64, float32 has no exact decimals
+                    if len(points) > 0:
+                        rect = [*points.min(axis=0).tolist(), *points.max(axis=0).tolist()]
+                    else:
+                        rect = None
+                    records.append({"file": filename, "page": page_num, "id": object.id, "type": "Ink",
+                                    "color": [c / 255 for c in object.color], "width": object.width,
+                                    "opacity": object.opacity, "rect": rect, "points": points.tolist()})
+
+                records += read_shapes(reader, filename, page_num)
+            return filename, records, len(reader), None
+        finally:
+            reader.close()
+    except Exception as error:
+        return filename, [], 0, f"{type(error).__name__}: {error}"
+
+def read_shapes(reader, filename: str, page_num: int) -> list[dict]:
+    # Shape annotations, which Reader does not turn into canvas objects, straight from the document
+    records = []
+    page = reader.doc[page_num] # Annotations only hold a weak reference to their page
+    annot = page.first_annot
+    while annot:
+        kind = annot.type[1]
+        if kind in SHAPE_TYPES:
+            vertices = annot.vertices or []
+            records.append({"file": filename, "page": page_num, "id": annot.info["id"], "type": kind,
+                            "color": list(annot.colors["stroke"] or []), "width": annot.border.get("width", 0),
+                            "opacity": annot.opacity if annot.opacity >= 0 else 1, "rect": [round(v, DECIMALS) for v in annot.rect],
+                            "points": [[round(x, DECIMALS), round(y, DECIMALS)] for x, y in vertices]})
+        annot = annot.next
+    return records
+
+def export(files: list[str], workers: int, simplify: bool):
+    # Yields the results of every file in order. Up to workers * 4 files are in flight at once.
+    # If a worker dies, for example on a crash in MuPDF, that file fails and the pool is restarted for the rest.
+    if len(files) == 1:
+        yield export_file(files[0], simplify, workers)
+        return
+
+    window = max(1, workers * 4)
+    executor = ProcessPoolExecutor(workers)
+    pending = []
+    index = 0
+    try:
+        while index < len(files) or pending:
+            while index < len(files) and len(pending) < window:
+                pending.append((files[index], executor.submit(export_file, files[index], simplify)))
+                index += 1
+
+            filename, future = pending.pop(0)
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                yield filename, [], 0, "worker process died"
+                executor.shutdown(cancel_futures=True)
+                executor = ProcessPoolExecutor(workers)
+                pending = [(name, executor.submit(export_file, name, simplify)) for name, _ in pending]
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+class JsonLinesWriter:
+    def __init__(self, filename: str):
+        self.file = sys.stdout if filename == "-" else open(filename, "w")
+
+    def write(self, records: list[dict]):
+        for record in records:
+            self.file.write(json.dumps(record, separators=(",", ":")))
+            self.file.write("\n")
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+class ParquetWriter:
+    # Columnar output in row groups of PARQUET_BATCH annotations. Needs pyarrow.
+    def __init__(self, filename: str):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            sys.exit("Parquet output needs pyarrow (pip install pyarrow)")
+
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            ("file", pyarrow.string()), ("page", pyarrow.int32()), ("id", pyarrow.string()), ("type", pyarrow.string()),
+            ("color", pyarrow.list_(pyarrow.float32())), ("width", pyarrow.float32()), ("opacity", pyarrow.float32()),
+            ("rect", pyarrow.list_(pyarrow.float32())), ("points", pyarrow.list_(pyarrow.list_(pyarrow.float32()))),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        self.batch = []
+
+    def write(self, records: list[dict]):
+        self.batch += records
+        if len(self.batch) >= PARQUET_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.writer.write_table(self.pyarrow.Table.from_pylist(self.batch, schema=self.schema))
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Export the ink and shape annotations of many PDFs")
+    parser.add_argument("paths", nargs="*", help="PDF files, or directories that are searched for them")
+    parser.add_argument("--files-from", help="file with one PDF path per line, or - for stdin")
+    parser.add_argument("--output", "-o", default="-", help="output file, - for stdout (JSON Lines only)")
+    parser.add_argument("--format", choices=("jsonl", "parquet"), default="jsonl")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--simplify", action="store_true", help="simplify ink the way the editor does")
+    args = parser.parse_args(argv)
+
+    paths = list(args.paths)
+    if args.files_from:
+        lines = sys.stdin if args.files_from == "-" else open(args.files_from)
+        paths += [line.strip() for line in lines if line.strip()]
+    files = find_pdfs(paths)
+    if len(files) == 0:
+        parser.error("no PDF files given")
+
+    if args.format == "parquet":
+        if args.output == "-":
+            parser.error("Parquet output needs --output")
+        writer = ParquetWriter(args.output)
+    else:
+        writer = JsonLinesWriter(args.output)
+
+    start = perf_counter()
+    pages = annotations = 0
+    failures = []
+    try:
+        for filename, records, page_count, error in export(files, args.workers, args.simplify):
+            if error is not None:
+                failures.append((filename, error))
+                continue
+            writer.write(records)
+            pages += page_count
+            annotations += len(records)
+    finally:
+        writer.close()
+
+    # Summary on stderr, so it does not mix with JSON Lines on stdout
+    elapsed = perf_counter() - start
+    done = len(files) - len(failures)
+    print(f"{done} files, {pages} pages, {annotations} annotations in {elapsed:.2f}s "
+          f"({done / elapsed:.1f} files/s, {pages / elapsed:.1f} pages/s, {annotations / elapsed:.0f} annotations/s)", file=sys.stderr)
+    for filename, error in failures:
+        print(f"Failed {filename}: {error}", file=sys.stderr)
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,17 @@
+import sys
+import importlib.util
+
+def lazy_import(name: str):
+    # Module that is only loaded when one of its attributes is first used, so heavy
+    # libraries are not imported before the window is shown. Type hints that name the
+    # module must not be evaluated at import time, hence `from __future__ import annotations`.
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -1,27 +1,56 @@
+from __future__ import annotations
+
 from PyQt6.QtWidgets import *
 from PyQt6.QtGui import *
 from PyQt6.QtCore import *
 import sys
-import re
+import os
 
-from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, Future
 from colorsys import hsv_to_rgb, rgb_to_hsv
-
-import pymupdf
-from pypdf import PdfWriter, PdfReader
-from pypdf.generic import PdfObject
-from struct import pack
+from collections import OrderedDict
+from datetime import datetime
 
 from reader import Reader
 from classes import *
+from classes import SIMPLIFY_TOLERANCE, PAINT_MARGIN
+from tiles import TileCache, zoom_bucket, bucket_zoom
+from renderer import PageRenderer, PREVIEW_BUCKET
+from pages import Page, PageLayout
+from commands import Command, CommandStack
+from store import AnnotationStore
+from autosave import Autosaver
+from selection import Selection, lasso_strokes
+from scene import PageItem, annotation_item
+import telemetry
+import sidecar
+
+from lazy import lazy_import
+np = lazy_import("numpy")
 
 RESOLUTION = 1920, 1080
 NUM_UNDOS = 25
+PAGE_DISTANCE = 2 # Pages kept loaded above and below the visible ones
+RESCALE_MARGIN = 1 # Tiles around the viewport that are re-rasterised in the background after zooming
+SAMPLE_DISTANCE = 1.5 # Screen pixels the pen must move before another tablet sample is stored
+DAMAGE_MARGIN = 2 # Screen pixels added around damaged rects, for antialiasing and smooth scaling of tiles
+ERASE_PREVIEW_WIDTH = 5 # Width of the outline drawn over strokes that are about to be erased
+GRADIENT_CACHE_SIZE = 64 # Hues whose colour picker gradient is kept
+OVERLAY_INTERVAL = 250 # Milliseconds between updates of the telemetry overlay
+STATUS_TIMEOUT = 5000 # Milliseconds status bar messages are shown for
+HANDLE_SIZE = 12 # Screen pixels of the handle that scales a selection
+SELECTION_COLOR = QColor(0, 120, 215)
+
+# Rendering engine, "tiles" or "scene", see GraphicsArea and SceneArea
+ENGINE = os.environ.get("PDFEDITOR_ENGINE", "tiles")
 
 USERNAME = 'Robin'
 
 class GraphicsArea(QGraphicsView):
-    def __init__(self, parent, size):
+    rescaled = pyqtSignal(int, object) # Internal, carries finished background rasterisations back to the UI thread
+    edited = pyqtSignal() # An edit was made, undone or redone
+
+    def __init__(self, parent, layout: PageLayout, renderer: PageRenderer | None = None, store: AnnotationStore | None = None):
         super(QGraphicsView, self).__init__(parent)
 
         # self.grabGesture(Qt.GestureType.TapAndHoldGesture) # Long touch gesture
@@ -35,26 +64,55 @@ class GraphicsArea(QGraphicsView):
         self.pen_color = 0, 0, 0
         self.pen_width = .5
         self.background_color = QColor(220, 220, 220)
-        self.aspect_ratio = size[0] / size[1]
-
-        self.original_size = QSize(*size)
-        self.image_size = QSize(*size)
-        self.image = QImage(self.image_size, QImage.Format.Format_RGB32)
-        self.image.fill(self.background_color)
+        self.setBackgroundBrush(QColor(160, 160, 160)) # Shows in the gaps between pages
 
-        self.painter = QPainter(self.image)
-        self.painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        self.page_layout = layout
+        self.image_size = layout.size.toSize()
         self.pen = QPen(QColor.fromRgb(*self.pen_color), self.pen_width, Qt.PenStyle.SolidLine)
-        self.painter.setPen(self.pen)
+
+        # Annotations of the resident pages
+        self.store = AnnotationStore() if store is None else store
+
+        # Pages within page_distance of the viewport are resident; the rest are evicted unless they have unsaved changes.
+        # page_loader(page_num) puts the annotations of a page that comes into range into the store.
+        self.pages: dict[int, Page] = {}
+        self.page_distance = PAGE_DISTANCE
+        self.page_loader = None
+        self.page_range = range(0)
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.timeout.connect(self.prefetch)
+
+        # Raster backing store, split into fixed-size tiles that are only rendered when visible
+        self.tiles = TileCache()
+
+        # Page content, rasterised in the background. Tiles drawn before their render arrived
+        # are kept in waiting_tiles, keyed by the render they wait for.
+        self.renderer = renderer
+        self.waiting_tiles: dict[tuple, tuple] = {}
+        if renderer is not None:
+            renderer.rendered.connect(self.pageRenderedEvent)
         
-        self.strokes: list[Stroke] = []
+        self.page: Page | None = None # Page that is being drawn on
+        self.stroke: Stroke | None = None # Unfinished stroke
         self.previous_point = None
         self.drawing = False
 
-        self.objects: list[Square, FreeText, Line] = []
+        # Ink capture: samples closer than sample_distance to the previous one are dropped,
+        # and finished strokes are simplified to within simplify_tolerance * pen width
+        self.sample_distance = SAMPLE_DISTANCE
+        self.simplify_tolerance = SIMPLIFY_TOLERANCE
 
         self.erasing = False
-        self.erased_strokes = {}
+        self.erased_strokes: dict[Stroke, Page] = {}
+
+        # Lasso tool: the lasso being drawn, in the coordinates of lasso_page, and the selected strokes.
+        # dragging is "move" or "scale" while the selection is dragged.
+        self.tool = "pen"
+        self.lasso: list[QPointF] | None = None
+        self.lasso_page: Page | None = None
+        self.selection: Selection | None = None
+        self.dragging: str | None = None
         
         # Canvas position and scale
         self.offset = QPointF(0, 0)
@@ -70,19 +128,31 @@ class GraphicsArea(QGraphicsView):
         self.max_zoom = 18
         self.min_zoom = .5
 
-        self.actions_stack = []
+        # Zoom that the tiles are currently rasterised at
+        self.raster_bucket = zoom_bucket(self.zoom)
+        self.raster_zoom = bucket_zoom(self.raster_bucket)
+
+        # After a zoom, tiles of the new zoom are rasterised in the background while the old tiles are shown scaled.
+        # Each rescale has a generation, and starting another one or editing cancels the running one.
+        self.rasteriser = ThreadPoolExecutor(1)
+        self.rescale_generation = 0
+        self.rescale_future: Future | None = None
+        self.rescaled.connect(self.rescaledEvent)
+
+        self.commands = CommandStack(self, NUM_UNDOS)
 
-        # TEST: Create a bunch of diagonal lines to test performance of erasing 
-        # dy = size[1] / 150
-        # for i in range(100):
-        #     self.strokes.append(Stroke(self.pen_color, self.pen_width, points=[QPointF(10 + i * 3 + x, 10 + x * dy) for x in range(50)]))
-        # self.refresh()
+        # Debug overlay of the telemetry measurements, toggled with F12 when telemetry is enabled
+        self.show_telemetry = False
+        self.telemetry_timer = QTimer(self)
+        self.telemetry_timer.timeout.connect(lambda: self.update(self.telemetry_rect()))
 
     def event(self, event: QEvent) -> bool:
         # print(event.type() in [QEvent.Type.TouchBegin, QEvent.Type.TouchUpdate, QEvent.Type.TouchEnd, QEvent.Type.TouchCancel])
         match event.type():
             case QEvent.Type.Show:
-                self.offset = QPointF(self.width(), self.height()) / 2
+                # Centre the document, or show the top of the first page if it does not fit
+                height = self.page_layout.size.height() * self.zoom
+                self.offset = QPointF(self.width() / 2, max(self.height(), height + 2 * self.page_layout.gap) / 2)
                 self.reset_painter()
                 self.refresh()
             case QEvent.Type.Gesture:
@@ -122,6 +192,7 @@ class GraphicsArea(QGraphicsView):
         # Is called once at the start of a pinch gesture.
         # This performs the zooming into the midpoint between the two gesture fingers
         if not self.pinching:
+            self.cancel_rescale()
             self.zoom_center = self.mapFromGlobal(gesture.centerPoint())
 
             before = self.drawRect.center()
@@ -141,25 +212,282 @@ class GraphicsArea(QGraphicsView):
         if self.previous_point is None:
             return
         pos = event.globalPosition()
-        rel_pos = pos - self.previous_point
-        self.offset += rel_pos / self.zoom
-        self.update()
+        self.pan(pos - self.previous_point)
         self.previous_point = pos
 
     def mouseReleaseEvent(self, event: QMouseEvent):
         self.previous_point = None
         event.accept()
 
+    def wheelEvent(self, event: QWheelEvent):
+        # Scroll through the pages
+        delta = event.pixelDelta()
+        if delta.isNull():
+            delta = event.angleDelta() / 2
+        self.pan(delta.toPointF())
+        event.accept()
+
+    def pan(self, delta: QPointF):
+        # Move the document by delta screen pixels. The pixels that stay visible are scrolled,
+        # so only the newly exposed strip is painted.
+        before = self.drawRect.topLeft()
+        self.offset += delta / self.zoom
+        self.update_draw_rect()
+
+        moved = self.drawRect.topLeft() - before
+        if not moved.isNull():
+            self.viewport().scroll(moved.x(), moved.y())
+            if self.show_telemetry:
+                self.update(self.telemetry_rect()) # The overlay stays in place
+
+    @telemetry.timed("reset_painter")
     def reset_painter(self):
-        height = self.original_size.height()
-        width = int(height * self.aspect_ratio)
-        self.image_size = QSize(int(width * self.zoom), int(height * self.zoom))
+        # Switch tiles to the zoom bucket of the current zoom.
+        # Tiles of the previous bucket stay cached until they are evicted.
+        self.raster_bucket = zoom_bucket(self.zoom)
+        self.raster_zoom = bucket_zoom(self.raster_bucket)
+
+    def create_page(self, page_num: int) -> Page:
+        return Page(page_num, self.page_layout.sizes[page_num], self.page_layout.origins[page_num])
+
+    def load_page(self, page_num: int) -> Page:
+        page = self.pages.get(page_num)
+        if page is None:
+            if self.page_loader is not None:
+                self.page_loader(page_num)
+            page = self.create_page(page_num)
+            for stroke in self.store.page(page_num, Stroke):
+                page.index.insert(stroke)
+            self.pages[page_num] = page
+        return page
+
+    def evict_page(self, page_num: int):
+        self.pages.pop(page_num)
+        self.store.unload(page_num)
+        self.tiles.invalidate(page_num)
+        self.waiting_tiles = {render: tile for render, tile in self.waiting_tiles.items() if render[0] != page_num}
+        if self.renderer is not None:
+            self.renderer.discard(page_num)
+
+    def update_pages(self, visible: range):
+        # Load the visible pages now and the pages around them when idle, and evict pages that are out of range
+        for page_num in visible:
+            self.load_page(page_num)
+
+        first = max(0, visible.start - self.page_distance)
+        last = min(len(self.page_layout), visible.stop + self.page_distance)
+        if range(first, last) == self.page_range:
+            return
+        self.page_range = range(first, last)
+
+        keep = self.commands.pages()
+        if self.selection is not None:
+            keep.add(self.selection.page.num)
+        for page_num in list(self.pages):
+            if page_num not in self.page_range and page_num not in self.store.dirty and self.pages[page_num] is not self.page \
+                    and page_num not in keep:
+                self.evict_page(page_num)
+
+        self.prefetch_timer.start(0)
+
+    def prefetch(self):
+        for page_num in self.page_range:
+            self.load_page(page_num)
+            if self.renderer is not None:
+                self.renderer.preview(page_num)
+
+    def page_at(self, pos: QPointF) -> Page | None:
+        # Resident page under a canvas position
+        page_num = self.page_layout.page_at(pos / self.zoom)
+        if page_num is None:
+            return None
+        return self.load_page(page_num)
+
+    def tile_snapshot(self, key: tuple) -> tuple:
+        # Everything a tile is rendered from, so that it can be rendered off the UI thread
+        page = self.pages[key[0]]
+        rect = self.tiles.tile_rect(key, page.size)
+        clipping_rect = self.tiles.page_rect(key, page.size)
+
+        content = self.page_content(key, clipping_rect)
+        # Index boxes are padded by the pen width, the query only by what antialiasing paints past the pen
+        margin = PAINT_MARGIN / bucket_zoom(key[1])
+        strokes = page.index.query(clipping_rect.adjusted(-margin, -margin, margin, margin))
+        objects = [object for object in self.store.page(page.num, Square, FreeText, Line) if object.colliderect(clipping_rect)]
+
+        return key, rect, clipping_rect, content, strokes, objects
+
+    def paint_tile(self, snapshot: tuple) -> QImage:
+        # Only reads the snapshot, so it is safe to call from the rasteriser thread
+        key, rect, clipping_rect, content, strokes, objects = snapshot
+        zoom = bucket_zoom(key[1])
+
+        image = QImage(rect.size(), QImage.Format.Format_RGB32)
+        image.fill(self.background_color)
+
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.translate(-rect.topLeft().toPointF())
+
+        if content is not None and content[0] is not None:
+            painter.drawImage(QRectF(rect), content[0], content[1])
+
+        margin = PAINT_MARGIN / zoom
+        for stroke in strokes:
+            if stroke.intersects_painted(clipping_rect, margin):
+                stroke.draw(painter, zoom=zoom)
+
+        for object in objects:
+            object.draw(painter, zoom=zoom)
+
+        painter.end()
+        return image
+
+    def render_tile(self, key: tuple) -> QImage:
+        snapshot = self.tile_snapshot(key)
+        self.wait_for_content(snapshot)
+        image = self.paint_tile(snapshot)
+
+        # Unfinished stroke and eraser previews, which are not in the index
+        page = self.pages[key[0]]
+        clipping_rect = snapshot[2]
+        zoom = bucket_zoom(key[1])
+        margin = PAINT_MARGIN / zoom
+        overlays = [stroke for stroke, stroke_page in self.erased_strokes.items()
+                    if stroke_page is page and stroke.intersects_painted(clipping_rect, margin, ERASE_PREVIEW_WIDTH)]
+        unfinished = self.stroke is not None and self.page is page and len(self.stroke.points) > 0
+        if len(overlays) == 0 and not unfinished:
+            return image
+
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.translate(-snapshot[1].topLeft().toPointF())
+        if unfinished:
+            self.stroke.draw(painter, zoom=zoom)
+        for stroke in overlays:
+            stroke.draw(painter, width=ERASE_PREVIEW_WIDTH, opacity=0.2, zoom=zoom)
+        painter.end()
+
+        return image
+
+    def page_content(self, key: tuple, clipping_rect: QRectF) -> tuple | None:
+        # Rasterised page content under a tile as (image, source rect, sharp), without waiting for it to be rendered.
+        # Until the sharp render arrives, the low resolution render of the whole page is used.
+        if self.renderer is None:
+            return None
+
+        page, bucket = key[:2]
+        image = self.renderer.get(page, bucket, clipping_rect.getCoords())
+        if image is not None:
+            return image, QRectF(image.rect()), True
+
+        preview = self.renderer.preview(page)
+        if preview is None:
+            return None, None, False
+
+        scale = bucket_zoom(PREVIEW_BUCKET)
+        return preview, QRectF(clipping_rect.topLeft() * scale, clipping_rect.size() * scale), False
+
+    def wait_for_content(self, snapshot: tuple):
+        # Re-render a tile once its page content is rasterised, if it was rendered without it
+        key, _, clipping_rect, content = snapshot[:4]
+        if content is not None and not content[2]:
+            self.waiting_tiles[(key[0], key[1], clipping_rect.getCoords())] = key
+
+    def pageRenderedEvent(self, key: tuple):
+        page, bucket, clip = key
+        if clip is None:
+            # A preview arrived, re-render every tile that is still waiting on this page
+            tiles = [tile for render, tile in self.waiting_tiles.items() if render[0] == page]
+        else:
+            tile = self.waiting_tiles.pop(key, None)
+            tiles = [] if tile is None else [tile]
+
+        for tile in tiles:
+            self.tiles.discard(tile)
+            if tile[0] in self.pages:
+                page = self.pages[tile[0]]
+                self.update(self.screen_rect(page, self.tiles.page_rect(tile, page.size)))
+
+    def paint_tiles(self, page: Page, rect: QRectF, draw):
+        # Paint directly onto the cached tiles of the current zoom that intersect rect (page coordinates).
+        # draw(painter, zoom) is called once per tile, with the painter translated to the tile's origin.
+        rect = QRectF(rect.topLeft() * self.raster_zoom, rect.size() * self.raster_zoom)
+        for key in self.tiles.visible(page.num, self.raster_bucket, page.size, rect):
+            image = self.tiles.get(key)
+            if image is None:
+                continue
+
+            painter = QPainter(image)
+            painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+            painter.translate(-self.tiles.tile_rect(key, page.size).topLeft().toPointF())
+            draw(painter, self.raster_zoom)
+            painter.end()
+
+    def rescale(self):
+        # Rasterise the tiles around the viewport at the current zoom in the background.
+        # The tiles of the previous zoom are shown scaled until all of them are done, and then swapped in at once.
+        self.cancel_rescale()
+        bucket = zoom_bucket(self.zoom)
+        if bucket == self.raster_bucket:
+            return
+
+        self.update_draw_rect()
+        zoom = bucket_zoom(bucket)
+        topleft = self.drawRect.topLeft().toPointF()
+        margin = RESCALE_MARGIN * self.tiles.tile_size
+        viewport = QRectF(self.viewport().rect()).adjusted(-margin, -margin, margin, margin)
+
+        snapshots = []
+        area = viewport.translated(-topleft)
+        for page_num in self.page_layout.pages_in(QRectF(area.topLeft() / self.zoom, area.size() / self.zoom)):
+            page = self.load_page(page_num)
+            area = viewport.translated(-(topleft + page.origin * self.zoom))
+            area = QRectF(area.topLeft() * zoom / self.zoom, area.size() * zoom / self.zoom)
+            for key in self.tiles.visible(page_num, bucket, page.size, area):
+                if key not in self.tiles:
+                    snapshots.append(self.tile_snapshot(key))
+
+        generation = self.rescale_generation
+        self.rescale_future = self.rasteriser.submit(self.rasterise, generation, bucket, snapshots)
+        self.rescale_future.add_done_callback(lambda future: self.rescaled.emit(generation, future))
+
+    def rasterise(self, generation: int, bucket: int, snapshots: list[tuple]) -> tuple[int, list]:
+        # Runs on the rasteriser thread and gives up as soon as the rescale is cancelled
+        tiles = []
+        for snapshot in snapshots:
+            if generation != self.rescale_generation:
+                return bucket, []
+            tiles.append((snapshot, self.paint_tile(snapshot)))
+
+        return bucket, tiles
+
+    def shutdown(self):
+        # Stop background work, before the window closes
+        self.prefetch_timer.stop()
+        self.cancel_rescale()
+        self.rasteriser.shutdown(cancel_futures=True)
+
+    def cancel_rescale(self):
+        self.rescale_generation += 1
+        if self.rescale_future is not None:
+            self.rescale_future.cancel()
+            self.rescale_future = None
+
+    def rescaledEvent(self, generation: int, future: Future):
+        if generation != self.rescale_generation or future.cancelled() or future.exception() is not None:
+            return
+        self.rescale_future = None
+
+        bucket, tiles = future.result()
+        for snapshot, image in tiles:
+            if snapshot[0][0] in self.pages:
+                self.tiles.put(snapshot[0], image)
+                self.wait_for_content(snapshot)
 
-        self.painter.end()
-        self.image = QImage(self.image_size, QImage.Format.Format_RGB32)
-        self.image.fill(self.background_color)
-        self.painter = QPainter(self.image)
-        self.painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        self.raster_bucket = bucket
+        self.raster_zoom = bucket_zoom(bucket)
+        self.update()
 
     def touchBeginEvent(self, event: QTouchEvent):
         self.old_touch_pos = event.point(0).position()
@@ -176,8 +504,7 @@ class GraphicsArea(QGraphicsView):
         rel_pos = pos - self.old_touch_pos
         self.old_touch_pos = pos
         
-        self.offset += rel_pos / self.zoom
-        self.update()
+        self.pan(rel_pos)
 
         event.accept()
         return True
@@ -185,65 +512,217 @@ class GraphicsArea(QGraphicsView):
     def touchEndEvent(self, event: QTouchEvent):
         self.pinching = False
         
-        # Every time the zoom changes, each stroke must be re-rasterised.
+        # Every time the zoom changes, each stroke must be re-rasterised, which happens in the background
         if self.old_zoom != self.zoom:
-            self.reset_painter()
+            self.rescale()
             self.old_zoom = self.zoom
 
-        self.refresh()
+        self.update()
 
         event.accept()
         return True
 
+    def update_draw_rect(self):
+        # Rect of the whole document on screen
+        center = (self.offset - self.zoom_center) * self.zoom + self.zoom_center
+        self.image_size = QSize(int(self.page_layout.size.width() * self.zoom), int(self.page_layout.size.height() * self.zoom))
+        self.drawRect = QRect()
+        self.drawRect.setSize(self.image_size)
+        self.drawRect.moveCenter(center.toPoint())
+
+    @telemetry.timed("drawForeground")
     def drawForeground(self, qp, rect):
         qp.save()
         qp.resetTransform()
 
         # Draw canvas to GraphicsView
-        height = self.original_size.height()
-        width = int(height * self.aspect_ratio)
+        self.update_draw_rect()
+        viewport = QRectF(self.viewport().rect())
+        topleft = self.drawRect.topLeft().toPointF()
+
+        # Only the tiles under the damaged part of the viewport are drawn
+        exposed = QRectF(self.mapFromScene(rect).boundingRect()).adjusted(-1, -1, 1, 1).intersected(viewport)
+
+        visible = viewport.translated(-topleft)
+        visible = self.page_layout.pages_in(QRectF(visible.topLeft() / self.zoom, visible.size() / self.zoom))
+        self.update_pages(visible)
+
+        scale = self.zoom / self.raster_zoom
+        if scale != 1:
+            qp.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+
+        # Tiles of an old zoom that were never rendered are not worth rendering now, during a pinch or until
+        # the rescale swaps in the tiles of the new zoom
+        stale = self.pinching or self.rescale_future is not None or zoom_bucket(self.zoom) != self.raster_bucket
+
+        for page_num in visible:
+            page = self.pages[page_num]
+            origin = self.page_origin(page)
+
+            area = exposed.translated(-origin)
+            if area.isEmpty():
+                continue
+            area = QRectF(area.topLeft() / scale, area.size() / scale)
+            for key in self.tiles.visible(page_num, self.raster_bucket, page.size, area):
+                rect = QRectF(self.tiles.tile_rect(key, page.size))
+                target = QRectF(origin + rect.topLeft() * scale, rect.size() * scale)
+
+                image = self.tiles.get(key)
+                if image is None and stale:
+                    self.draw_placeholder(qp, key, page, origin, target)
+                    continue
+                if image is None:
+                    image = self.render_tile(key)
+                    self.tiles.put(key, image)
+
+                qp.drawImage(target, image, QRectF(image.rect()))
+
+        if self.selection is not None and self.selection.page.num in visible:
+            self.draw_selection(qp)
+        if self.lasso is not None:
+            self.draw_lasso(qp)
+
+        if telemetry.ENABLED:
+            telemetry.frame()
+            if self.show_telemetry:
+                self.draw_telemetry(qp)
 
-        center = (self.offset - self.zoom_center) * self.zoom + self.zoom_center
-        self.image_size = QSize(int(width * self.zoom), int(height * self.zoom))
-        self.drawRect = QRect()
-        self.drawRect.setSize(self.image_size)
-        self.drawRect.moveCenter(center.toPoint())
-        qp.drawImage(self.drawRect, self.image, self.image.rect())
         qp.restore()
 
+    def telemetry_rect(self) -> QRect:
+        return QRect(self.viewport().width() - 560, 0, 560, 20 + 16 * len(telemetry.histograms))
+
+    def toggle_telemetry(self):
+        self.show_telemetry = not self.show_telemetry
+        if self.show_telemetry:
+            self.telemetry_timer.start(OVERLAY_INTERVAL)
+        else:
+            self.telemetry_timer.stop()
+        self.update()
+
+    def draw_telemetry(self, qp: QPainter):
+        rect = self.telemetry_rect()
+        qp.fillRect(rect, QColor(0, 0, 0, 180))
+        qp.setPen(QColor(255, 255, 255))
+        qp.setFont(QFont("monospace", 9))
+        for i, line in enumerate(telemetry.report()):
+            qp.drawText(rect.left() + 10, rect.top() + 16 + 16 * i, line)
+
+    def page_origin(self, page: Page) -> QPointF:
+        # Top left of a page in the viewport, rounded independently of the scroll position so panning moves it by whole pixels
+        origin = page.origin * self.zoom
+        return self.drawRect.topLeft().toPointF() + QPointF(round(origin.x()), round(origin.y()))
+
+    def screen_rect(self, page: Page, rect: QRectF) -> QRect:
+        # Viewport pixels covered by a rect in page coordinates
+        rect = QRectF(self.page_origin(page) + rect.topLeft() * self.zoom, rect.size() * self.zoom)
+        return rect.toAlignedRect().adjusted(-DAMAGE_MARGIN, -DAMAGE_MARGIN, DAMAGE_MARGIN, DAMAGE_MARGIN)
+
+    def draw_placeholder(self, qp: QPainter, key: tuple, page: Page, origin: QPointF, target: QRectF):
+        # Stands in for a missing tile while the tiles of a new zoom are rasterised: cached tiles of a coarser zoom
+        # scaled up, or else the page content without annotations. Nothing is rendered on the UI thread.
+        qp.save()
+        qp.setClipRect(target)
+        rect = self.tiles.page_rect(key, page.size)
+        coarser = self.tiles.coarser(page.num, key[1], rect, page.size)
+        if coarser is not None:
+            for coarse in coarser:
+                coarse_rect = self.tiles.page_rect(coarse, page.size)
+                image = self.tiles.get(coarse)
+                qp.drawImage(QRectF(origin + coarse_rect.topLeft() * self.zoom, coarse_rect.size() * self.zoom),
+                             image, QRectF(image.rect()))
+        else:
+            qp.fillRect(target, self.background_color)
+            preview = None if self.renderer is None else self.renderer.preview(page.num)
+            if preview is not None:
+                scale = bucket_zoom(PREVIEW_BUCKET)
+                qp.drawImage(target, preview, QRectF(rect.topLeft() * scale, rect.size() * scale))
+
+        # The stroke being drawn and the eraser previews, which the cached tiles may not have
+        qp.translate(origin)
+        if self.stroke is not None and self.page is page and len(self.stroke.points) > 0:
+            self.stroke.draw(qp, zoom=self.zoom)
+        for stroke, stroke_page in self.erased_strokes.items():
+            if stroke_page is page:
+                stroke.draw(qp, width=ERASE_PREVIEW_WIDTH, opacity=0.2, zoom=self.zoom)
+        qp.restore()
+
+    def selection_rect(self) -> QRectF:
+        # Canvas rect of the selection
+        rect = self.selection.rect.translated(self.selection.page.origin)
+        return QRectF(rect.topLeft() * self.zoom, rect.size() * self.zoom)
+
+    def selection_damage(self) -> QRect:
+        # Viewport pixels covered by the selection and its handle
+        rect = self.selection_rect().translated(self.drawRect.topLeft().toPointF()).toAlignedRect()
+        return rect.adjusted(-HANDLE_SIZE, -HANDLE_SIZE, HANDLE_SIZE, HANDLE_SIZE)
+
+    def draw_selection(self, qp: QPainter):
+        origin = self.page_origin(self.selection.page)
+        viewport = QRectF(self.viewport().rect())
+        visible = QRectF((viewport.topLeft() - origin) / self.zoom, viewport.size() / self.zoom)
+        self.selection.draw(qp, origin, self.zoom, self.raster_zoom, visible)
+
+        # Outline, with the handle that scales it on the bottom right corner
+        rect = self.selection.rect
+        rect = QRectF(origin + rect.topLeft() * self.zoom, rect.size() * self.zoom)
+        qp.setPen(QPen(SELECTION_COLOR, 1, Qt.PenStyle.DashLine))
+        qp.setBrush(Qt.BrushStyle.NoBrush)
+        qp.drawRect(rect)
+        handle = QRectF(0, 0, HANDLE_SIZE, HANDLE_SIZE)
+        handle.moveCenter(rect.bottomRight())
+        qp.fillRect(handle, SELECTION_COLOR)
+
+    def draw_lasso(self, qp: QPainter):
+        origin = self.page_origin(self.lasso_page)
+        qp.setPen(QPen(SELECTION_COLOR, 1, Qt.PenStyle.DashLine))
+        qp.drawPolyline(QPolygonF([origin + point * self.zoom for point in self.lasso]))
+
     def screen_to_canvas(self, pos: QPointF) -> QPointF:
-        ratio = self.image.height() / self.original_size.height()
-        return (pos - self.drawRect.topLeft().toPointF()) * ratio / self.zoom
+        return pos - self.drawRect.topLeft().toPointF()
 
     def canvas_to_screen(self, pos: QPointF) -> QPointF:
-        ratio = self.image.height() / self.original_size.height()
-        return pos * self.zoom / ratio + self.drawRect.topLeft().toPointF()
+        return pos + self.drawRect.topLeft().toPointF()
 
     def setColor(self, color: tuple):
         self.pen_color = [int(c) for c in color]
         self.pen = QPen(QColor(*self.pen_color), self.pen_width, Qt.PenStyle.SolidLine)
-        self.painter.setPen(self.pen)
+
+        # Picking a colour recolours the selection
+        if self.selection is not None:
+            self.selection.recolor(self.pen_color)
+            self.update(self.selection_damage())
 
     def setWidth(self, width: int):
         self.pen_width = width
         self.pen = QPen(QColor(*self.pen_color), self.pen_width, Qt.PenStyle.SolidLine)
-        self.painter.setPen(self.pen)
 
+    @telemetry.timed("eraseEvent")
     def eraseEvent(self, pos: QPointF):
         if self.previous_point is None:
+            self.cancel_rescale()
             self.previous_point = pos
             return
         
         self.drawing = False
 
         line = QLineF(self.previous_point / self.zoom, pos / self.zoom)
-        for i, stroke in enumerate(self.strokes):
-            if stroke.collideline(line):
-                if i not in self.erased_strokes:
-                    self.erased_strokes[i] = stroke
-                    stroke.draw(self.painter, width=5, opacity=0.2, zoom=self.zoom)
+        bounds = QRectF(line.p1(), line.p2()).normalized()
+        for page_num in self.page_layout.pages_in(bounds):
+            page = self.pages.get(page_num)
+            if page is None:
+                continue
+
+            # Test in the page's own coordinates
+            local = line.translated(-page.origin)
+            candidates = page.index.segments(bounds.translated(-page.origin))
+            candidates = {stroke: segments for stroke, segments in candidates.items() if stroke not in self.erased_strokes}
+            for stroke in collideline_strokes(candidates, local):
+                self.erased_strokes[stroke] = page
+                rect = self.stroke_bounds(stroke)
+                self.paint_tiles(page, rect, lambda painter, zoom: stroke.draw(painter, width=ERASE_PREVIEW_WIDTH, opacity=0.2, zoom=zoom))
+                self.update(self.screen_rect(page, rect))
 
-        self.update()
         self.previous_point = pos
 
     def normalise(self, point: QPoint | QPointF) -> QPointF:
@@ -253,39 +732,198 @@ class GraphicsArea(QGraphicsView):
         return QPointF(point.x() * self.image_size.width(), point.y() * self.image_size.height())
 
     def tabletPressEvent(self, pos: QPointF):
-        self.strokes.append(Stroke(self.pen_color, self.pen_width))
+        self.page = self.page_at(pos)
+        if self.page is None:
+            return
+        self.cancel_rescale()
+
+        self.stroke = Stroke(self.pen_color, self.pen_width)
         self.previous_point = pos
         self.drawing = True
 
     def tabletMoveEvent(self, pos: QPointF):
-        if len(self.strokes) == 0:
+        if self.stroke is None:
             self.drawing = False
         if self.drawing:
-            self.strokes[-1].add(pos / self.zoom)
-            self.painter.setPen(QPen(QColor(*self.strokes[-1].color), self.pen_width * self.zoom, Qt.PenStyle.SolidLine))
-            self.painter.drawLine(pos, self.previous_point)
+            # Live decimation, the skipped samples are covered by the next segment
+            distance = pos - self.previous_point
+            if len(self.stroke.points) > 0 and QPointF.dotProduct(distance, distance) < self.sample_distance ** 2:
+                return
+
+            # Points are stored relative to the page the stroke started on
+            origin = self.page.origin
+            self.stroke.add(pos / self.zoom - origin)
+
+            # Draw the new segment onto the tiles it passes through
+            line = QLineF(self.previous_point / self.zoom - origin, pos / self.zoom - origin)
+            pen = QPen(QColor(*self.stroke.color), self.pen_width, Qt.PenStyle.SolidLine)
+            rect = QRectF(line.p1(), line.p2()).normalized().adjusted(-self.pen_width, -self.pen_width, self.pen_width, self.pen_width)
+
+            def draw(painter: QPainter, zoom: float):
+                pen.setWidthF(self.pen_width * zoom)
+                painter.setPen(pen)
+                painter.drawLine(line.p1() * zoom, line.p2() * zoom)
+
+            self.paint_tiles(self.page, rect, draw)
+            self.update(self.screen_rect(self.page, rect))
             self.previous_point = pos
 
+    def finish_stroke(self):
+        stroke, page = self.stroke, self.page
+        self.stroke = None
+        self.drawing = False
+        if stroke is None or len(stroke.points) == 0:
+            return
+
+        if self.simplify_tolerance:
+            stroke.simplify(stroke.width * self.simplify_tolerance)
+
+        self.store.add(page.num, stroke)
+        page.index.insert(stroke)
+        self.commands.push(Command(added=[(stroke, page)]))
+        self.edited.emit()
+
+        # Tiles cached at other zooms have not seen the new stroke
+        self.tiles.invalidate(page.num, QRectF(*stroke.rect), page.size, keep_bucket=self.raster_bucket)
+
     def tabletReleaseEvent(self, pos: QPointF):
         self.previous_point = None
+        self.finish_stroke()
+
         if len(self.erased_strokes) > 0:
-            self.actions_stack.append(list(self.erased_strokes.values()))
+            erased = list(self.erased_strokes.items())
+            self.erased_strokes = {}
+            self.commands.push(Command(removed=erased), apply=True)
+            self.edited.emit()
 
-            for action in self.actions_stack:
-                for stroke in action:
-                    if stroke in self.strokes:
-                        self.strokes.remove(stroke)
-            self.refresh()
+        # Finish rasterising at the current zoom, if drawing interrupted it
+        self.rescale()
 
-            self.erased_strokes = {}
+    def set_tool(self, tool: str):
+        # "pen" or "lasso"
+        self.finish_stroke()
+        self.clear_selection()
+        self.tool = tool
+
+    def toggle_lasso(self):
+        self.set_tool("pen" if self.tool == "lasso" else "lasso")
+
+    def lassoPressEvent(self, pos: QPointF):
+        # Drag the selection by its handle to scale it, or by anything else inside it to move it.
+        # Pressing outside of it lets go of it and starts a new lasso.
+        self.previous_point = pos
+        if self.selection is not None:
+            rect = self.selection_rect()
+            corner = rect.bottomRight() - pos
+            if abs(corner.x()) <= HANDLE_SIZE and abs(corner.y()) <= HANDLE_SIZE:
+                self.dragging = "scale"
+            elif rect.contains(pos):
+                self.dragging = "move"
+            else:
+                self.clear_selection()
+            if self.dragging is not None:
+                return
+
+        self.lasso_page = self.page_at(pos)
+        if self.lasso_page is None:
+            return
+        self.cancel_rescale()
+        self.lasso = [pos / self.zoom - self.lasso_page.origin]
+
+    def lassoMoveEvent(self, pos: QPointF):
+        if self.dragging is not None:
+            before = self.selection_damage()
+            if self.dragging == "move":
+                self.selection.translate((pos - self.previous_point) / self.zoom)
+            else:
+                # Scale about the top left corner, by how far the pen moved along the diagonal
+                anchor = self.selection_rect().topLeft()
+                diagonal = self.selection_rect().bottomRight() - anchor
+                length = QPointF.dotProduct(self.previous_point - anchor, diagonal)
+                if length > 0:
+                    factor = QPointF.dotProduct(pos - anchor, diagonal) / length
+                    self.selection.scale_by(factor, self.selection.rect.topLeft())
+
+            self.update(before.united(self.selection_damage()))
+            self.previous_point = pos
+            return
+
+        if self.lasso is None:
+            return
+        distance = pos - self.previous_point
+        if QPointF.dotProduct(distance, distance) < self.sample_distance ** 2:
+            return
+
+        self.lasso.append(pos / self.zoom - self.lasso_page.origin)
+        self.update(self.screen_rect(self.lasso_page, QRectF(self.lasso[-2], self.lasso[-1]).normalized()))
+        self.previous_point = pos
 
-            # Make sure length of erased_strokes <= number of undos
-            # self.actions_stack = self.actions_stack[-min(NUM_UNDOS, len(self.actions_stack)):]
+    def lassoReleaseEvent(self, pos: QPointF):
+        self.previous_point = None
+        if self.dragging is not None:
+            # A scaled image is blurred, so it is rendered again at the new size
+            if self.dragging == "scale":
+                self.selection.invalidate()
+                self.update(self.selection_damage())
+            self.dragging = None
+            return
+
+        if self.lasso is None:
+            return
+        lasso, page = self.lasso, self.lasso_page
+        self.lasso = self.lasso_page = None
+        self.update(self.screen_rect(page, QPolygonF(lasso).boundingRect()))
+
+        strokes = lasso_strokes(page, lasso)
+        if len(strokes) > 0:
+            self.select(page, strokes)
+        self.rescale()
+
+    def select(self, page: Page, strokes: list[Stroke]):
+        # Take the strokes out of the page's index, so the tiles are drawn without them and the selection over them
+        self.selection = Selection(page, strokes)
+        for stroke in strokes:
+            self.selection.order[stroke] = page.index.remove(stroke)
+
+        self.tiles.invalidate(page.num, self.selection.bounds, page.size)
+        self.update(self.selection_damage())
+
+    def clear_selection(self):
+        # Let go of the selection. Changes to it are applied to the strokes here, as one command that replaces them.
+        selection, self.selection = self.selection, None
+        self.dragging = None
+        if selection is None:
+            return
+
+        page = selection.page
+        self.update(self.screen_rect(page, selection.rect))
+        if not selection.changed:
+            for stroke in selection.strokes:
+                page.index.insert(stroke, selection.order[stroke])
+            self.tiles.invalidate(page.num, selection.bounds, page.size)
+            return
+
+        pairs = selection.bake()
+        command = Command(added=[(new, page) for _, new in pairs], removed=[(old, page) for old, _ in pairs])
+        command.removed_order = dict(selection.order)
+        command.added_order = {new: selection.order[old] for old, new in pairs}
+        self.commands.push(command, apply=True)
+        self.edited.emit()
 
     def handleTablet(self, event: QTabletEvent = None, pos: QPointF = None):
         # Tablet-Stylus press, move and release events
         if event.pointerType() == QPointingDevice.PointerType.Eraser:
             self.eraseEvent(pos)
+        # Releasing the eraser button finishes the erase, whatever the tool
+        if self.tool == "lasso" and len(self.erased_strokes) == 0:
+            match event.type():
+                case QEvent.Type.TabletPress:
+                    self.lassoPressEvent(pos)
+                case QEvent.Type.TabletMove:
+                    self.lassoMoveEvent(pos)
+                case QEvent.Type.TabletRelease:
+                    self.lassoReleaseEvent(pos)
+            return
         match event.type():
             case QEvent.Type.TabletPress:
                 self.tabletPressEvent(pos)
@@ -294,6 +932,7 @@ class GraphicsArea(QGraphicsView):
             case QEvent.Type.TabletRelease:
                 self.tabletReleaseEvent(pos)
 
+    @telemetry.timed("tabletEvent")
     def tabletEvent(self, event: QTabletEvent):
         # Calculate relative cursor position
         pos = self.screen_to_canvas(event.position())
@@ -305,8 +944,8 @@ class GraphicsArea(QGraphicsView):
         # Detects top stylus button press
         self.erasing = False
         if event.buttons() & Qt.MouseButton.RightButton:
-            if len(self.strokes[-1].points) > 0:
-                self.strokes.append(Stroke(self.pen_color, self.pen_width))
+            if self.stroke is not None:
+                self.finish_stroke()
                 self.previous_point = None
             self.erasing = True
 
@@ -315,54 +954,273 @@ class GraphicsArea(QGraphicsView):
             self.eraseEvent(pos)
             return
 
+        # Each handler repaints only the part of the screen it changed
         self.handleTablet(event, pos)
-
-        # Update screen
-        self.update()
         event.accept()
 
-    def update(self):
-        # Update QGraphicsView.drawForeground() call
-        QGraphicsView.update(self)
-        self.scene().invalidate()
-
-    def refresh(self):
-        self.image.fill(self.background_color)
-
-        topleft = self.screen_to_canvas(QPointF(0, 0)) / self.zoom
-        bottomright = self.screen_to_canvas(QPointF(self.width(), self.height())) / self.zoom
-        clipping_rect = QRectF(topleft, bottomright)
-
-        for stroke in self.strokes:
-            lines = stroke.colliderect(clipping_rect)
-            if lines:
-                stroke.draw(self.painter, lines=lines, zoom=self.zoom)
-
-        for object in self.objects:
-            lines = object.colliderect(clipping_rect)
-            if lines:
-                object.draw(self.painter, zoom=self.zoom)
-
-        self.update()
-
-    def add_stroke(self, object: Ink):
-        points = [QPointF(point[0], point[1]) for point in object.points]
+    def update(self, rect: QRect | None = None):
+        # Repaint the whole viewport, or only a damaged rect of it, through drawForeground()
+        if rect is None:
+            self.viewport().update()
+        else:
+            self.viewport().update(rect)
+
+    @telemetry.timed("refresh")
+    def refresh(self, page_num: int | None = None):
+        # Visible tiles of a page, or of all pages, are re-rendered on the next paint
+        self.tiles.invalidate(page_num)
+        if self.rescale_future is not None:
+            self.rescale()
+
+        page = self.pages.get(page_num)
+        self.update(None if page is None else self.screen_rect(page, QRectF(QPointF(), page.size)))
+
+    def stroke_bounds(self, stroke: Stroke) -> QRectF:
+        # Rect in page coordinates that a stroke, or its erase preview, may draw over
+        margin = max(stroke.width, ERASE_PREVIEW_WIDTH)
+        return QRectF(*stroke.rect).adjusted(-margin, -margin, margin, margin)
+
+    def add_objects(self, items: list[tuple], order: dict[Stroke, int] | None = None):
+        # Put (annotation, page) pairs on their pages, restoring the drawing order of strokes that have one
+        damaged = {}
+        for object, page in items:
+            self.store.add(page.num, object)
+            if isinstance(object, Stroke):
+                page.index.insert(object, None if order is None else order.get(object))
+            damaged.setdefault(page, []).append(object)
+        self.damage(damaged)
+
+    def remove_objects(self, items: list[tuple]) -> dict[Stroke, int]:
+        # Take (annotation, page) pairs off their pages, and return the drawing order of the removed strokes
+        order = {}
+        damaged = {}
+        for object, page in items:
+            self.store.remove(page.num, object.id)
+            if isinstance(object, Stroke):
+                position = page.index.remove(object)
+                if position is not None:
+                    order[object] = position
+            damaged.setdefault(page, []).append(object)
+        self.damage(damaged)
+        return order
+
+    def damage(self, damaged: dict[Page, list]):
+        # Re-render the tiles under annotations that were added or removed, a page at a time
+        for page, objects in damaged.items():
+            if not all(isinstance(object, Stroke) for object in objects):
+                self.refresh(page.num)
+                continue
+
+            rects = [self.stroke_bounds(object) for object in objects]
+            self.tiles.invalidate_rects(page.num, rects, page.size)
+            bounds = QRectF()
+            for rect in rects:
+                bounds |= rect
+            self.update(self.screen_rect(page, bounds))
+
+    def undo(self):
+        # Not while a stroke or erase is in progress, since it is not in the history yet.
+        # A changed selection is applied first, so that is what is undone.
+        self.clear_selection()
+        if self.stroke is None and len(self.erased_strokes) == 0 and self.commands.undo() is not None:
+            self.rescale()
+            self.edited.emit()
+
+    def redo(self):
+        self.clear_selection()
+        if self.stroke is None and len(self.erased_strokes) == 0 and self.commands.redo() is not None:
+            self.rescale()
+            self.edited.emit()
+
+    def add_stroke(self, object: Ink, page_num: int):
+        points = object.points
         color = object.color
         width = object.width
         highlight = object.highlight
         opacity = object.opacity
-        self.strokes.append(Stroke(color, width, points, opacity, highlight, imported=True)) 
+        stroke = Stroke(color, width, points, opacity, highlight, imported=True, id=object.id)
+        self.store.add(page_num, stroke, track=False)
+
+    def add_rect(self, object: Square, page_num: int):
+        self.store.add(page_num, object, track=False)
+
+    def add_text(self, object: FreeText, page_num: int):
+        self.store.add(page_num, object, track=False)
+
+    def add_line(self, object: Line, page_num: int):
+        self.store.add(page_num, object, track=False)
+
+class SceneArea(GraphicsArea):
+    # Rendering engine where every page and annotation is an item of the scene, which culls them with its BSP
+    # index and paints them. Annotations are cached in device coordinates by Qt, and zoom and pan only set
+    # the view transform and scroll position. Input, editing and the overlays are those of GraphicsArea,
+    # which are kept in sync with the items; the tile cache is only used for its tile geometry.
+    def __init__(self, parent, layout: PageLayout, renderer: PageRenderer | None = None, store: AnnotationStore | None = None):
+        super().__init__(parent, layout, renderer, store)
+
+        # The view is positioned by the scroll bars, which are hidden
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.setTransformationAnchor(QGraphicsView.ViewportAnchor.NoAnchor)
+        self.setResizeAnchor(QGraphicsView.ViewportAnchor.NoAnchor)
+        self.setRenderHints(QPainter.RenderHint.Antialiasing | QPainter.RenderHint.SmoothPixmapTransform)
+        self._scene.setItemIndexMethod(QGraphicsScene.ItemIndexMethod.BspTreeIndex)
+        self._scene.setSceneRect(QRectF(QPointF(), layout.size))
+
+        self.page_items: dict[int, PageItem] = {}
+        self.annotation_items: dict[object, QGraphicsItem] = {}
+        self.view_state = None # Zoom and position the view was last put at
+
+    def sync_view(self):
+        # Put the view where offset and zoom put the document, so the scene maps to the viewport as in the tiles
+        self.update_draw_rect()
+        state = (self.zoom, self.drawRect.topLeft())
+        if state == self.view_state:
+            return
+        self.view_state = state
+
+        # The scene must be larger than the viewport and cover it, or the view centres it instead of scrolling
+        size = QSizeF(self.viewport().size()) / self.zoom
+        visible = QRectF(-self.drawRect.topLeft().toPointF() / self.zoom, size)
+        if not self._scene.sceneRect().contains(visible):
+            rect = QRectF(QPointF(), self.page_layout.size).united(visible)
+            self._scene.setSceneRect(rect.adjusted(-size.width(), -size.height(), size.width(), size.height()))
+
+        self.setTransform(QTransform.fromScale(self.zoom, self.zoom))
+        self.horizontalScrollBar().setValue(-self.drawRect.left())
+        self.verticalScrollBar().setValue(-self.drawRect.top())
+
+        visible = QRectF(self.viewport().rect()).translated(-self.drawRect.topLeft().toPointF())
+        self.update_pages(self.page_layout.pages_in(QRectF(visible.topLeft() / self.zoom, visible.size() / self.zoom)))
+
+    def update(self, rect: QRect | None = None):
+        self.sync_view()
+        super().update(rect)
+
+    def keyPressEvent(self, event: QKeyEvent):
+        # The arrow and page keys would move the hidden scroll bars away from where offset puts the view
+        event.ignore()
+
+    def pan(self, delta: QPointF):
+        # Scrolling the view moves the pixels that stay visible and paints the exposed strip
+        self.offset += delta / self.zoom
+        self.sync_view()
+        if self.show_telemetry:
+            self.update(self.telemetry_rect())
+
+    def rescale(self):
+        # Items paint their caches again at the new zoom themselves, there is nothing to rasterise in the background
+        self.cancel_rescale()
+        self.reset_painter()
+        self.update()
 
-    def add_rect(self, object: Square):
-        self.objects.append(object)
+    @telemetry.timed("refresh")
+    def refresh(self, page_num: int | None = None):
+        # Items of a page, or of all pages, are painted again instead of from their caches
+        page_items = self.page_items.values() if page_num is None else filter(None, [self.page_items.get(page_num)])
+        for page_item in page_items:
+            page_item.update()
+            for item in page_item.childItems():
+                item.update()
+        self.update()
 
-    def add_text(self, object: FreeText):
-        self.objects.append(object)
+    def page_origin(self, page: Page) -> QPointF:
+        # Where the view puts the page, unrounded
+        return self.drawRect.topLeft().toPointF() + page.origin * self.zoom
+
+    def load_page(self, page_num: int) -> Page:
+        page = self.pages.get(page_num)
+        if page is None:
+            page = super().load_page(page_num)
+            # Children are created before the page is added, so the scene indexes them all at once
+            self.page_items[page_num] = page_item = PageItem(page, self)
+            self.sync_items(page, self.store.page(page_num))
+            self._scene.addItem(page_item)
+        return page
+
+    def evict_page(self, page_num: int):
+        page_item = self.page_items.pop(page_num)
+        for item in page_item.childItems():
+            del self.annotation_items[item.object]
+        self._scene.removeItem(page_item)
+        super().evict_page(page_num)
+
+    def sync_items(self, page: Page, objects: list):
+        # Items for the annotations of a page that are shown, and none for the ones that were removed or are selected
+        page_item = self.page_items.get(page.num)
+        for object in objects:
+            shown = page_item is not None and self.store.get(page.num, object.id) is object and \
+                (not isinstance(object, Stroke) or object in page.index)
+            item = self.annotation_items.get(object)
+            if shown and item is None:
+                item = annotation_item(object, page, page_item)
+                if item is not None:
+                    self.annotation_items[object] = item
+            elif not shown and item is not None:
+                del self.annotation_items[object]
+                self._scene.removeItem(item)
+
+    def damage(self, damaged: dict[Page, list]):
+        # The scene repaints under the items that are added and removed
+        for page, objects in damaged.items():
+            self.sync_items(page, objects)
+
+    def paint_tiles(self, page: Page, rect: QRectF, draw):
+        # Unfinished strokes and eraser previews are overlays, drawn by drawForeground()
+        pass
+
+    def finish_stroke(self):
+        stroke, page = self.stroke, self.page
+        super().finish_stroke()
+        if stroke is not None and page is not None:
+            self.sync_items(page, [stroke])
+
+    def select(self, page: Page, strokes: list[Stroke]):
+        super().select(page, strokes)
+        self.sync_items(page, strokes)
+
+    def clear_selection(self):
+        selection = self.selection
+        super().clear_selection()
+        if selection is not None:
+            self.sync_items(selection.page, selection.strokes)
+
+    @telemetry.timed("drawForeground")
+    def drawForeground(self, qp, rect):
+        # Over the items: eraser previews, the unfinished stroke, the selection and the lasso
+        qp.save()
+        qp.resetTransform()
+        qp.setRenderHint(QPainter.RenderHint.Antialiasing)
+
+        for stroke, page in self.erased_strokes.items():
+            qp.save()
+            qp.translate(self.page_origin(page))
+            stroke.draw(qp, width=ERASE_PREVIEW_WIDTH, opacity=0.2, zoom=self.zoom)
+            qp.restore()
+
+        if self.stroke is not None and self.page is not None and len(self.stroke.points) > 0:
+            qp.save()
+            qp.translate(self.page_origin(self.page))
+            self.stroke.draw(qp, zoom=self.zoom)
+            qp.restore()
+
+        if self.selection is not None and self.selection.page.num in self.pages:
+            self.draw_selection(qp)
+        if self.lasso is not None:
+            self.draw_lasso(qp)
+
+        if telemetry.ENABLED:
+            telemetry.frame()
+            if self.show_telemetry:
+                self.draw_telemetry(qp)
+
+        qp.restore()
 
-    def add_line(self, object: Line):
-        self.objects.append(object)
+ENGINES = {"tiles": GraphicsArea, "scene": SceneArea}
 
 class ColorPicker(QWidget):
+    colorChanged = pyqtSignal(object) # Picked colour as [r, g, b]
+
     def __init__(self, parent, size: tuple, initial_color: tuple = (0, 0, 0), *args, **kwargs):
         super(ColorPicker, self).__init__(parent, *args, **kwargs)
 
@@ -380,14 +1238,20 @@ class ColorPicker(QWidget):
         container = QHBoxLayout()
         layout.addLayout(container)
 
-        self.image_size = QSize(50, 50)
+        self.image_size = QSize(*size)
         self.canvas_size = size
 
-        self.canvas_image = QImage(self.image_size, QImage.Format.Format_RGB32)
-        self.canvas_image.fill(QColor(255, 255, 255))
+        # Saturation/value gradient per hue, least recently used first
+        self.gradients: OrderedDict[int, QPixmap] = OrderedDict()
         self.label = QLabel()
         container.addWidget(self.label)
 
+        # The cursor is a small widget over the gradient, so moving it only repaints around it
+        self.cursor = QLabel(self.label)
+        self.cursor.setFixedSize(10, 10)
+        self.cursor.setStyleSheet("background: white; border: 1px solid black; border-radius: 5px;")
+        self.cursor.setAttribute(Qt.WidgetAttribute.WA_TransparentForMouseEvents)
+
         self.slider = QSlider(Qt.Orientation.Vertical, self)
         self.slider.setMinimum(0)
         self.slider.setMaximum(360)
@@ -395,7 +1259,6 @@ class ColorPicker(QWidget):
         self.color_value = self.slider.value()
         self.slider.setTickInterval(1)
         self.slider.valueChanged.connect(self.sliderChangeEvent)
-        self.slider.sliderReleased.connect(self.draw)
         styles = 'QSlider::groove:vertical { border-image: url(hue-map.png) 0 0 0 0 stretch stretch; position: absolute; left: 8px; right: 7px; width: 12px; height: ' + str(self.canvas_size[1]) + '; }'
         styles += "QSlider::handle:vertical { height: 8px; background: #979EA8; margin: 0 -4px; border-style:solid; border-color: grey; border-width:1px; border-radius:3px; }"
         self.slider.setStyleSheet(styles)
@@ -415,10 +1278,10 @@ class ColorPicker(QWidget):
         y = 1 - self.mouse_pos.y() / self.canvas_size[1]
         rgb = hsv_to_rgb(self.color_value / 360, x, y)
         self.selected_color = [c * 255 for c in rgb]
-        self.parent().penColorChangedEvent(self.selected_color)
+        self.colorChanged.emit(self.selected_color)
 
     def mousePressEvent(self, event: QMouseEvent):
-        self.mouse_pos = self.label.mapFromGlobal(event.pos())
+        self.mouse_pos = self.label.mapFrom(self, event.position().toPoint())
         self.update_color()
         self.pressed = True
         self.draw_cursor()
@@ -428,7 +1291,7 @@ class ColorPicker(QWidget):
         if not self.pressed:
             return
         
-        self.mouse_pos = self.label.mapFromGlobal(event.pos())
+        self.mouse_pos = self.label.mapFrom(self, event.position().toPoint())
         self.mouse_pos.setX(max(0, min(self.canvas_size[0], self.mouse_pos.x())))
         self.mouse_pos.setY(max(0, min(self.canvas_size[1], self.mouse_pos.y())))
         self.update_color()
@@ -443,39 +1306,45 @@ class ColorPicker(QWidget):
     def sliderChangeEvent(self):
         self.color_value = self.slider.value()
         self.update_color()
-        # self.draw()
+        self.draw()
+
+    def gradient(self, hue: int) -> QPixmap:
+        if hue in self.gradients:
+            self.gradients.move_to_end(hue)
+            return self.gradients[hue]
 
-    def draw(self):
         width = self.image_size.width()
         height = self.image_size.height()
 
-        ptr = self.canvas_image.bits()
-        ptr.setsize(self.canvas_image.sizeInBytes())
-        arr = ptr.asarray()
+        # At a fixed hue every channel is v * (1 - s * (1 - c)), where c is the channel of the pure hue.
+        # This is the same as hsv_to_rgb() for every pixel, with saturation along x and value up y.
+        pure = np.array(hsv_to_rgb(hue / 360, 1, 1))
+        s = np.arange(width) / width
+        v = (height - 1 - np.arange(height)) / height
+        rgb = v[:, None, None] * (1 - s[None, :, None] * (1 - pure))
+
+        image = QImage(self.image_size, QImage.Format.Format_RGB32)
+        ptr = image.bits()
+        ptr.setsize(image.sizeInBytes())
+        pixels = np.frombuffer(ptr, dtype=np.uint8).reshape(height, image.bytesPerLine())[:, :width * 4].reshape(height, width, 4)
+        pixels[..., 2::-1] = (rgb * 255).astype(np.uint8) # BGR Color Format
+        pixels[..., 3] = 255
+
+        self.gradients[hue] = QPixmap.fromImage(image)
+        while len(self.gradients) > GRADIENT_CACHE_SIZE:
+            self.gradients.popitem(last=False)
 
-        for y in range(height):
-            for x in range(width):
-                index = ((height - y - 1) * width + x) * 4 # 4 bytes per pixel
-                rgb = hsv_to_rgb(self.color_value / 360, x / width, y / height)
-                # BGR Color Format
-                arr[index] = int(rgb[2] * 255)
-                arr[index + 1] = int(rgb[1] * 255)
-                arr[index + 2] = int(rgb[0] * 255)
+        return self.gradients[hue]
 
+    def draw(self):
+        self.label.setPixmap(self.gradient(self.color_value))
         self.draw_cursor()
-        self.label.adjustSize()
 
     def draw_cursor(self):
-        image = self.canvas_image.scaled(*self.canvas_size)
-        qp = QPainter(image)
-        qp.setBrush(QColor(255, 255, 255))
-        qp.drawEllipse(self.mouse_pos, 4, 4)
-        qp.end()
-        pixmap = QPixmap.fromImage(image)
-        self.label.setPixmap(pixmap)
+        self.cursor.move(self.mouse_pos - QPoint(self.cursor.width() // 2, self.cursor.height() // 2))
 
 class Window(QMainWindow):
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, engine: str = ENGINE):
         super(QMainWindow, self).__init__()
         # self.setWindowFlags(Qt.WindowType.CustomizeWindowHint | Qt.WindowType.FramelessWindowHint)
 
@@ -483,187 +1352,118 @@ class Window(QMainWindow):
         self.setWindowTitle('Editor')
 
         self.filename = filename
-        self.reader = Reader(filename)
-        if len(self.reader.objects) == 0:
+        self.engine = engine
+        self.reader: Reader | None = None
+        self.gv: GraphicsArea | None = None
+
+        if telemetry.ENABLED:
+            self.lag_monitor = telemetry.LagMonitor(self)
+            self.lag_monitor.start()
+
+        # Show the empty window first and open the document once it has been painted,
+        # which is also when PyMuPDF and NumPy are first used and imported
+        self.show()
+        QTimer.singleShot(0, self.open_document)
+
+    def open_document(self):
+        self.reader = Reader(self.filename)
+        if len(self.reader) == 0:
             print("Document is not readable")
-            sys.exit()
+            self.close()
+            return
 
-        page_size = [int(x) for x in self.reader.page_info[0]["size"]]
-        self.gv = GraphicsArea(self, page_size)
-        self.setCentralWidget(self.gv)
+        if self.reader.use_cache and self.reader.cache is None:
+            sidecar.build_in_background(self.filename)
 
-        self.colorpicker = ColorPicker(self, (300, 300))
+        layout = PageLayout([self.reader.page_size(i) for i in range(len(self.reader))])
+        self.renderer = PageRenderer(self.filename)
+        self.store = AnnotationStore()
+        self.gv = ENGINES[self.engine](self, layout, self.renderer, self.store)
+        self.gv.page_loader = self.load_page
+        self.setCentralWidget(self.gv)
 
-        self.load_page()
+        # Changes are saved in the background, a moment after the last edit
+        self.autosaver = Autosaver(self.reader, self.store, self.renderer)
+        self.autosaver.saving.connect(self.savingEvent)
+        self.autosaver.saved.connect(self.savedEvent)
+        self.autosaver.failed.connect(self.saveFailedEvent)
+        self.gv.edited.connect(self.autosaver.schedule)
 
-        self.show()
+        # Docked beside the view rather than over it, so nothing covers the viewport and panning can scroll it
+        self.colorpicker = ColorPicker(None, (300, 300))
+        self.colorpicker.colorChanged.connect(self.penColorChangedEvent)
+        dock = QDockWidget("Colour", self)
+        dock.setWidget(self.colorpicker)
+        self.addDockWidget(Qt.DockWidgetArea.RightDockWidgetArea, dock)
 
         save_shortcut = QShortcut(QKeySequence("Ctrl+S"), self)
         save_shortcut.activated.connect(self.save)
+
+        undo_shortcut = QShortcut(QKeySequence("Ctrl+Z"), self)
+        undo_shortcut.activated.connect(self.gv.undo)
+
+        for keys in ("Ctrl+Y", "Ctrl+Shift+Z"):
+            redo_shortcut = QShortcut(QKeySequence(keys), self)
+            redo_shortcut.activated.connect(self.gv.redo)
+
+        lasso_shortcut = QShortcut(QKeySequence("Ctrl+L"), self)
+        lasso_shortcut.activated.connect(self.gv.toggle_lasso)
         
         exit_shortcut = QShortcut(QKeySequence("Escape"), self)
         exit_shortcut.activated.connect(self.closeEvent)
 
+        if telemetry.ENABLED:
+            telemetry_shortcut = QShortcut(QKeySequence("F12"), self)
+            telemetry_shortcut.activated.connect(self.gv.toggle_telemetry)
+
     def penColorChangedEvent(self, color: tuple):
         self.gv.setColor(color)
 
     def closeEvent(self, event: QCloseEvent | None = None):
-        self.save()
+        if self.gv is not None:
+            # Waits only for changes that were not autosaved yet
+            self.gv.clear_selection()
+            self.autosaver.flush()
+            self.autosaver.close()
+            self.gv.shutdown()
+            self.renderer.close()
         self.close()
 
+    @telemetry.timed("save")
     def save(self, save_filename: str = None):
-        if save_filename is None:
-            save_filename = self.filename
-            
-        doc = pymupdf.open()
-        page = doc.new_page()
-
-        # Append strokes
-        for stroke in self.gv.strokes:
-            points = [(point.x(), point.y()) for point in stroke.points]
-            color = [c / 255 for c in stroke.color]
-
-            annot = page.add_ink_annot([points])
-            annot.set_border(width=stroke.width)
-            annot.set_colors(stroke=color)
-            annot.set_opacity(stroke.opacity)
-            annot.update()
-            if stroke.highlight:
-                annot.update(fill_color=color)
-
-        # Append objects
-        for object in self.gv.objects:
-            # WRITE OBJECTS TO 'writer'
-            match object:
-                case Square():
-                    rect = (*object.pos, object.pos[0] + object.size[0], object.pos[1] + object.size[1])
-                    border_color = [c / 255 for c in object.border_color]
-                    fill_color = [c / 255 for c in object.fill_color]
-
-                    annot = page.add_rect_annot(rect)
-                    annot.set_colors(stroke=border_color, fill=fill_color)
-                    # annot.set_opacity(object.opacity)
-                    annot.set_border(width=object.border_width)
-                    ...
-                case FreeText():
-                    ...
-                case Line():
-                    ...
-                case _:
-                    ...
-            annot.update()
-            object.nm = annot.info["id"]
-
-        page_objects = {page_num: {annot.info["id"]: annot.xref for annot in page.annots()} for page_num, page in enumerate(doc.pages())}
-
-        def replace_attr(obj_str: str, match_string: str, replace_string: str) -> str:
-            match = re.search(match_string, obj_str)
-            if not match:
-                return obj_str
-            
-            return obj_str[:match.start()] + replace_string + obj_str[match.end():]
-            
-            
-        def get_form_of_annot(match_xref: int) -> bytes | None:
-            xreflen = doc.xref_length() # number of objects in file
-            for xref in range(1, xreflen): # skip item 0!
-                if xref == match_xref + 1:
-                    # if stream := doc.xref_stream(xref):
-                    return doc.xref_stream(xref)
-                        # stream = replace_attr(stream, b"\n(.+?) RG", b"\n0 0 1 RG")
-                        # doc.update_stream(xref, stream)
-
-        for object in self.gv.objects:
-            match object:
-                case Square():
-                    # rect["/NM"] = object.id
-                    # rect["/FillOpacity"] = object.opacity
-                    # rect["/C"] = [1, 0, 0]
-                    # for page in page_objects:
-                    #     objects = page_objects[page]
-                    #     if not object.nm:
-                    #         continue
-
-                    # fill_color = " ".join([str(c / 255) for c in object.fill_color])
-                    # border_color = " ".join([str(c / 255) for c in object.border_color])
-
-                    # xref = objects[object.nm]
-                    # stream = get_form_of_annot(xref)
-                    # print(doc.xref_object(xref))
-
-                    # fill_color = [pack("f", c / 255) for c in object.fill_color]
-                    # print(fill_color)
-
-                    # replace_bytes = b"\n" + b" ".join(fill_color) + b" RG"
-                    # stream = replace_attr(stream, b"\n(.+?) RG", replace_bytes)
-                    # doc.update_stream(xref + 1, stream)
-                    # obj = doc.xref_object(xref, 1)
-                    # print(obj)
-
-                    # obj = replace_attr(obj, "/C\[.+?\]", f"/C[{border_color}]")
-                    # obj = replace_attr(obj, "/IC\[.+?\]", f"/IC[{fill_color}]")
-                    # obj = replace_attr(obj, "/NM\(.+?\)", f"/NM({object.id})")
-
-
-
-                    # doc.update_object(xref, obj)
-                    ...
-                case _:
-                    ...
-
-        doc.save(save_filename)
-        # reader = PdfReader(save_filename)
-        # for annot in reader.pages[0]["/Annots"]:
-        #     obj = annot.get_object()
-        #     if obj["/Subtype"] == "/Square":
-        #         print(obj)
-
-        # objects = {page_num : [a.get_object() for a in page["/Annots"]] for page_num, page in enumerate(writer.pages)}
-        # objects = objects[0] # first page, fix later for multiple pages
-        
-        # def get_obj_by_nm(obj_nm: str):
-        #     for annot_obj in objects:
-        #         if annot_obj["/NM"] == obj_nm:
-        #             return dict(annot_obj)
-                
-        #     return None
-
-        # writer = PdfWriter()
-        # reader = PdfReader(save_filename)
-        # for page in reader.pages:
-        #     writer.add_page(page)
-
-        # for object in self.gv.objects:
-        #     match object:
-        #         case Square():
-        #             rect = get_obj_by_nm(object.nm)
-        #             rect["/NM"] = object.id
-        #             rect["/FillOpacity"] = object.opacity
-        #             rect["/C"] = [1, 0, 0]
-        #             print(rect)
-        #             writer.add_annotation(0, rect)
-        #         case _:
-        #             ...
-
-        # writer.write(save_filename)
-
-    def process_object(self, object):
+        # Starts saving in the background; only the changed annotations are copied here.
+        # What the selection shows is what is saved.
+        self.gv.clear_selection()
+        self.autosaver.save(save_filename)
+
+    def savingEvent(self, pages: int):
+        self.statusBar().showMessage(f"Saving {pages} page{'s' if pages != 1 else ''}...")
+
+    def savedEvent(self, filename: str):
+        self.statusBar().showMessage(f"Saved {os.path.basename(filename)} at {datetime.now():%H:%M:%S}", STATUS_TIMEOUT)
+
+    def saveFailedEvent(self, error: str):
+        # Stays until the next save
+        self.statusBar().showMessage(f"Saving failed: {error}")
+
+    def process_object(self, object, page_num: int):
         match object:
             case Ink():
-                self.gv.add_stroke(object)
+                self.gv.add_stroke(object, page_num)
             case Square():
-                self.gv.add_rect(object)
+                self.gv.add_rect(object, page_num)
             case FreeText():
-                self.gv.add_text(object)
+                self.gv.add_text(object, page_num)
             case Line():
-                self.gv.add_line(object)
+                self.gv.add_line(object, page_num)
             case _:
                 ...
 
-    def load_page(self, page_num: int = 0) -> Reader:
-        page_objects = self.reader.objects[page_num]
-        for object in page_objects:
-            self.process_object(object)
+    def load_page(self, page_num: int):
+        # Put the annotations of a page into the store, as they are in the file
+        for object in self.reader.read_page(page_num):
+            self.process_object(object, page_num)
+        self.store.mark_saved(page_num)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
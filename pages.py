@@ -0,0 +1,56 @@
+from PyQt6.QtCore import *
+
+from bisect import bisect_right
+
+from spatial import StrokeIndex
+
+PAGE_GAP = 12 # Vertical space between pages, in page coordinates
+
+class Page:
+    # A page that is resident on the canvas. Its annotations are in the AnnotationStore, in the page's own coordinates.
+    def __init__(self, num: int, size: QSizeF, origin: QPointF):
+        self.num = num
+        self.size = size
+        self.origin = origin # Top left corner in document coordinates
+        self.index = StrokeIndex() # Spatial index of all finished strokes
+
+    @property
+    def rect(self) -> QRectF:
+        return QRectF(self.origin, self.size)
+
+class PageLayout:
+    # Pages stacked vertically and centred horizontally, in document coordinates
+    def __init__(self, sizes: list, gap: float = PAGE_GAP):
+        self.gap = gap
+        self.sizes = [QSizeF(*size) for size in sizes]
+
+        width = max((size.width() for size in self.sizes), default=0)
+        self.tops = []
+        self.origins = []
+        y = 0
+        for size in self.sizes:
+            self.tops.append(y)
+            self.origins.append(QPointF((width - size.width()) / 2, y))
+            y += size.height() + gap
+
+        self.size = QSizeF(width, max(0, y - gap))
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def page_rect(self, page_num: int) -> QRectF:
+        return QRectF(self.origins[page_num], self.sizes[page_num])
+
+    def page_at(self, pos: QPointF) -> int | None:
+        page_num = bisect_right(self.tops, pos.y()) - 1
+        if page_num < 0 or not self.page_rect(page_num).contains(pos):
+            return None
+        return page_num
+
+    def pages_in(self, rect: QRectF) -> range:
+        # Pages whose vertical extent overlaps rect
+        first = max(0, bisect_right(self.tops, rect.top()) - 1)
+        if first < len(self) and self.tops[first] + self.sizes[first].height() < rect.top():
+            first += 1
+        last = bisect_right(self.tops, rect.bottom())
+        return range(first, max(first, last))
@@ -1,79 +1,223 @@
-import pymupdf
-import pymupdf.extra
+from __future__ import annotations
+
+import os
+from uuid import uuid4
 from classes import *
-from pypdf import PdfReader
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import telemetry
+import sidecar
+from lazy import lazy_import
+pymupdf = lazy_import("pymupdf")
+
+PAGE_CACHE_SIZE = 16 # Number of pages whose parsed annotations are kept
+READ_WORKERS = os.cpu_count() or 1
+CHUNKS_PER_WORKER = 4 # Pages are handed out in this many contiguous ranges per worker, to balance uneven pages
+MIN_PARALLEL_PAGES = 32 # Fewer pages than this are read in this process, as starting workers costs more
+
+# Like the renderer, workers read pages with their own handle to the document
+_reader = None
+
+def _open_reader(filename: str, simplify: bool):
+    global _reader
+    _reader = Reader(filename, cache_size=0, simplify=simplify, use_cache=False)
+
+def _read_pages(page_nums: list[int]) -> tuple[list[list], list[tuple[int, str]]]:
+    # Parsed pages, and the ids given to annotations, which must be given to them in the parent's document too
+    _reader.renamed.clear()
+    return [_reader.read_annotations(page_num) for page_num in page_nums], list(_reader.renamed)
 
 class Reader:
-    def __init__(self, filename):
+    def __init__(self, filename, cache_size: int = PAGE_CACHE_SIZE, simplify: bool = True, use_cache: bool | None = None):
         super().__init__()
 
         self.filename = filename
+        self.cache_size = cache_size
+        self.simplify = simplify # Simplify ink the same way as strokes drawn on the canvas
+        self.use_cache = sidecar.ENABLED if use_cache is None else use_cache
+        self.cache: sidecar.CachedDocument | None = None # Annotations parsed when the file was last opened
 
         self.page_info = {}
-        self.objects = {}
+        self.objects: OrderedDict[int, list] = OrderedDict() # Parsed pages, least recently used first
+        self.renamed: list[tuple[int, str]] = [] # (xref, id) of annotations given a new /NM id
 
-        self.ghost_reader = PdfReader(filename)
+        self.open()
 
-        self.read_annotations()
+    def open(self):
+        # Single document handle, kept open so pages can be parsed when they are first requested
+        self.doc = pymupdf.open(self.filename)
+        self.page_count = self.doc.page_count
 
-        self.ghost_reader.close()
+        self.cache = sidecar.load(self.filename, self.simplify) if self.use_cache else None
+        if self.cache is not None:
+            # Give annotations the ids they were given when the cache was written
+            for xref, obj_id in self.cache.renamed:
+                self.doc.xref_set_key(xref, "NM", pymupdf.get_pdf_str(obj_id))
+            self.renamed += self.cache.renamed
+            self.page_info = {page_num: {"size": size} for page_num, size in enumerate(self.cache.sizes)}
 
-    def read_annotations(self):
-        self.doc = pymupdf.open(self.filename)
+    def close(self):
+        self.doc.close()
 
-        self.objects = {}
-        for i, page in enumerate(self.doc):
-            rect = page.cropbox
-            self.page_info[i] = {"size": [rect.width, rect.height]}
+    def replace(self, filename: str | None, saved: int):
+        # Read a newly saved version of the file, which was either appended to the file or written to filename
+        # and is swapped in. It has the first saved of the ids in renamed; the others were given while it
+        # was written, so they are given again.
+        renamed = self.renamed[saved:]
+        self.close()
+        if filename is not None:
+            os.replace(filename, self.filename)
+        self.renamed = []
+        self.open()
 
-            self.objects[i] = []
-            for annot in page.annots():
-                self.add_annotation(i, annot)
+        for xref, obj_id in renamed:
+            self.doc.xref_set_key(xref, "NM", pymupdf.get_pdf_str(obj_id))
+        self.renamed += renamed
 
-        self.doc.close()
+    def __len__(self) -> int:
+        return self.page_count
+
+    def page_size(self, page_num: int) -> list[float]:
+        # Read from the page tree without loading the page
+        if page_num not in self.page_info:
+            rect = self.doc.page_cropbox(page_num)
+            self.page_info[page_num] = {"size": [rect.width, rect.height]}
+
+        return self.page_info[page_num]["size"]
+
+    def read_page(self, page_num: int) -> list:
+        if page_num in self.objects:
+            self.objects.move_to_end(page_num)
+            return self.objects[page_num]
+
+        self.objects[page_num] = self.read_annotations(page_num)
+        while len(self.objects) > self.cache_size:
+            self.objects.popitem(last=False)
+
+        return self.objects[page_num]
+
+    def read_pages(self, page_nums: list[int] | None = None, workers: int = READ_WORKERS) -> list[list]:
+        # Parse many pages at once, by default all of them, split across worker processes. Results are in page order.
+        page_nums = list(range(self.page_count)) if page_nums is None else list(page_nums)
+        missing = [page_num for page_num in page_nums if page_num not in self.objects]
 
-    def add_annotation(self, page_num: int, obj: pymupdf.Annot):
+        results = {}
+        if workers <= 1 or len(missing) < MIN_PARALLEL_PAGES or self.cache is not None:
+            for page_num in missing:
+                results[page_num] = self.read_annotations(page_num)
+        else:
+            size = -(-len(missing) // (workers * CHUNKS_PER_WORKER))
+            chunks = [missing[i:i + size] for i in range(0, len(missing), size)]
+            with ProcessPoolExecutor(min(workers, len(chunks)), initializer=_open_reader, initargs=(self.filename, self.simplify)) as executor:
+                for chunk, (pages, renamed) in zip(chunks, executor.map(_read_pages, chunks)):
+                    results.update(zip(chunk, pages))
+                    for xref, obj_id in renamed:
+                        self.doc.xref_set_key(xref, "NM", pymupdf.get_pdf_str(obj_id))
+                    self.renamed += renamed
+
+        pages = []
+        for page_num in page_nums:
+            if page_num in results:
+                self.objects[page_num] = results[page_num]
+            self.objects.move_to_end(page_num)
+            pages.append(self.objects[page_num])
+        while len(self.objects) > self.cache_size:
+            self.objects.popitem(last=False)
+
+        return pages
+
+    def write_cache(self):
+        # Parse every page and store the results for the next time the file is opened
+        key = sidecar.file_key(self.filename)
+        pages = self.read_pages()
+        sizes = [self.page_size(page_num) for page_num in range(self.page_count)]
+        sidecar.write(self.filename, key, self.simplify, sizes, pages, self.renamed)
+
+    @telemetry.timed("read_annotations")
+    def read_annotations(self, page_num: int) -> list:
+        if self.cache is not None:
+            return self.cache.page(page_num)
+
+        page = self.doc[page_num]
+        self.page_size(page_num)
+
+        # Matrix from PDF to page coordinates, as applied by Annot.vertices
+        matrix = page.transformation_matrix * page.derotation_matrix
+
+        # Walk the linked list of annotations; page.annots() looks each one up again by xref
+        objects = []
+        ids = set()
+        annot = page.first_annot
+        while annot:
+            # Annotations are told apart by their /NM id, so give one to those without a unique one.
+            # It is derived from the xref, so the same file always gets the same ids.
+            if annot.info["id"] in ids or not annot.info["id"]:
+                obj_id = f"xref-{annot.xref}"
+                if obj_id in ids:
+                    obj_id = str(uuid4()) # Another annotation on the page already has the id
+                self.doc.xref_set_key(annot.xref, "NM", pymupdf.get_pdf_str(obj_id))
+                self.renamed.append((annot.xref, obj_id))
+            ids.add(annot.info["id"])
+
+            obj = self.add_annotation(page_num, annot, matrix)
+            if obj is not None:
+                objects.append(obj)
+            annot = annot.next
+
+        return objects
+
+    def read_ink_list(self, obj: pymupdf.Annot, matrix: pymupdf.Matrix) -> np.ndarray:
+        # Parse the first /InkList path straight from the PDF object, much faster than Annot.vertices
+        kind, value = self.doc.xref_get_key(obj.xref, "InkList")
+        if kind != "array" or "R" in value:
+            return np.asarray(obj.vertices[0], dtype=np.float32)
+
+        path = value.lstrip("[ ").split("]", 1)[0]
+        xy = np.array(path.replace("[", " ").split(), dtype=np.float32).reshape(-1, 2)
+
+        x, y = xy[:, 0], xy[:, 1]
+        a, b, c, d, e, f = (np.float32(v) for v in matrix)
+        return np.stack((x * a + y * c + e, x * b + y * d + f), axis=1)
+
+    def add_annotation(self, page_num: int, obj: pymupdf.Annot, matrix: pymupdf.Matrix):
         obj_id = obj.info["id"]
         match obj.type[1]:
             case "Ink":
-                points = obj.vertices[0]
+                points = self.read_ink_list(obj, matrix)
                 color = obj.colors["stroke"]
                 width = obj.border["width"]
                 if width == 0: opacity = obj.opacity
                 else: opacity = 1
-                self.objects[page_num].append(Ink(id=obj_id, points=points, color=color, width=width, opacity=opacity))
+                if self.simplify:
+                    points = simplify_points(points, width * SIMPLIFY_TOLERANCE)
+                return Ink(id=obj_id, points=points, color=color, width=width, opacity=opacity)
             # case "Square":
             #     rect = obj.rect
             #     opacity = obj.opacity
             #     border_color = obj.colors["stroke"]
             #     fill_color = obj.colors["fill"]
             #     border_width = obj.border["width"]
-
-            #     # Get FillOpacity from other PdfReader
-            #     annot_id = obj.info["id"]
-            #     alt_annots = [annot.get_object() for annot in self.ghost_reader.pages[page_num]["/Annots"]]
-            #     for annot in alt_annots:
-            #         if annot_id == annot["/NM"] and "/FillOpacity" in annot:
-            #             opacity = annot["/FillOpacity"]
-            #             # print(annot)
-
-            #     self.objects[page_num].append(Square(id=obj_id, rect=rect, opacity=opacity, border_color=border_color, fill_color=fill_color, border_width=border_width))
+            #     kind, value = self.doc.xref_get_key(obj.xref, "FillOpacity")
+            #     if kind != "null": opacity = float(value)
+            #     return Square(id=obj_id, rect=rect, opacity=opacity, border_color=border_color, fill_color=fill_color, border_width=border_width)
             # case "FreeText":
             #     text = obj.info["content"]
             #     color = obj.colors["stroke"]
             #     rect = obj.rect
             #     opacity = obj.opacity
-            #     self.objects[page_num].append(FreeText(id=obj_id, text=text, color=color, rect=rect, opacity=opacity))
+            #     return FreeText(id=obj_id, text=text, color=color, rect=rect, opacity=opacity)
             # case "Line":
             #     points = obj.vertices
             #     color = obj.colors["stroke"]
             #     width = obj.border["width"]
             #     opacity = obj.opacity
-            #     self.objects[page_num].append(Line(id=obj_id, points=points, color=color, width=width, opacity=opacity))
+            #     return Line(id=obj_id, points=points, color=color, width=width, opacity=opacity)
             # case _:
             #     print(obj)
-                # annotation = {"subtype": obj["/Subtype"], "location": obj["/Rect"]}
-                # self.objects[i].append(annotation)
+
+        return None
 
 if __name__ == "__main__":
-    Reader("test.pdf")
\ No newline at end of file
+    Reader("test.pdf").read_page(0)
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+from PyQt6.QtGui import *
+from PyQt6.QtCore import *
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, Future
+
+from tiles import bucket_zoom, zoom_bucket
+from lazy import lazy_import
+pymupdf = lazy_import("pymupdf")
+
+RENDER_WORKERS = 2
+RENDER_MEMORY = 128 * 1024 * 1024 # Bytes of rendered page images kept before the least recently used are evicted
+PREVIEW_BUCKET = zoom_bucket(1) # Whole pages are rendered at this zoom and shown until sharp renders arrive
+
+# PyMuPDF must not be used from several threads, so pages are rasterised in worker processes,
+# each holding its own handle to the document.
+_document = None
+
+def _open_document(filename: str):
+    global _document
+    _document = pymupdf.open(filename)
+
+def _render(page_num: int, zoom: float, clip: tuple | None) -> tuple[int, int, int, bytes]:
+    page = _document[page_num]
+    matrix = pymupdf.Matrix(zoom, zoom)
+
+    # Annotations are drawn by the canvas, so only the page content is rasterised
+    if clip is None:
+        pixmap = page.get_pixmap(matrix=matrix, alpha=False, annots=False)
+    else:
+        pixmap = page.get_pixmap(matrix=matrix, clip=pymupdf.Rect(*clip), alpha=False, annots=False)
+
+    return pixmap.width, pixmap.height, pixmap.stride, pixmap.samples
+
+class PageRenderer(QObject):
+    rendered = pyqtSignal(tuple) # (page, zoom bucket, clip) of a render that is ready
+    finished = pyqtSignal(tuple, object) # Internal, carries results from the executor back to the UI thread
+
+    def __init__(self, filename: str, workers: int = RENDER_WORKERS, max_bytes: int = RENDER_MEMORY):
+        super().__init__()
+
+        self.filename = filename
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.executor = ProcessPoolExecutor(workers, initializer=_open_document, initargs=(filename,))
+
+        # (page, zoom bucket, clip) -> QImage, ordered from least to most recently used
+        self.cache: OrderedDict[tuple, QImage] = OrderedDict()
+        self.bytes = 0
+        self.pending: dict[tuple, Future] = {}
+
+        self.finished.connect(self.store)
+
+    def get(self, page: int, bucket: int, clip: tuple | None) -> QImage | None:
+        # Returns the cached render, or starts rendering it in the background and returns None
+        key = (page, bucket, clip)
+        image = self.cache.get(key)
+        if image is not None:
+            self.cache.move_to_end(key)
+            return image
+
+        if key not in self.pending:
+            self.submit(key)
+
+        return None
+
+    def submit(self, key: tuple):
+        page, bucket, clip = key
+        future = self.executor.submit(_render, page, bucket_zoom(bucket), clip)
+        future.add_done_callback(lambda future: self.finished.emit(key, future))
+        self.pending[key] = future
+
+    def preview(self, page: int) -> QImage | None:
+        return self.get(page, PREVIEW_BUCKET, None)
+
+    def store(self, key: tuple, future: Future):
+        if self.pending.get(key) is not future:
+            return
+        del self.pending[key]
+
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        width, height, stride, samples = future.result()
+        image = QImage(samples, width, height, stride, QImage.Format.Format_RGB888)
+        image = image.convertToFormat(QImage.Format.Format_RGB32) # Copies out of samples
+
+        self.cache[key] = image
+        self.bytes += image.sizeInBytes()
+        while self.bytes > self.max_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.bytes -= evicted.sizeInBytes()
+
+        self.rendered.emit(key)
+
+    def discard(self, page: int | None = None):
+        # Drop cached and queued renders of a page, or of every page
+        for key in list(self.pending):
+            if page is None or key[0] == page:
+                self.pending.pop(key).cancel()
+
+        for key in list(self.cache):
+            if page is None or key[0] == page:
+                self.bytes -= self.cache.pop(key).sizeInBytes()
+
+    def suspend(self):
+        # Stop the workers, so no process has the document open, such as while another version replaces it.
+        # Renders that were queued are cancelled, and started again by resume().
+        self.executor.shutdown(cancel_futures=True)
+
+    def resume(self):
+        self.executor = ProcessPoolExecutor(self.workers, initializer=_open_document, initargs=(self.filename,))
+        for key, future in list(self.pending.items()):
+            if future.cancelled():
+                self.submit(key)
+
+    def close(self):
+        self.discard()
+        self.executor.shutdown(cancel_futures=True)
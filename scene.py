@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+from PyQt6.QtWidgets import *
+from PyQt6.QtGui import *
+from PyQt6.QtCore import *
+
+from classes import Stroke, Square, FreeText, Line
+from pages import Page
+from tiles import zoom_bucket, bucket_zoom
+
+ITEM_MARGIN = 4 # Page points around an item's outline for the pen and antialiasing, two pixels at the smallest zoom
+SHAPE_Z = 2 ** 40 # Shapes are drawn over the strokes, as in the tiles
+
+# Items of the scene-graph rendering engine. A page is an item, and the annotations on it are its children,
+# in the page's own coordinates. Annotations are cached in device coordinates, so panning reuses them and only
+# zooming or editing paints them again.
+
+class PageItem(QGraphicsItem):
+    # Background and rasterised content of a resident page. The content is requested from the renderer in
+    # the same tiles as the tile engine uses, and the part not rendered yet comes from the page preview.
+    def __init__(self, page: Page, area):
+        super().__init__()
+        self.page = page
+        self.area = area
+        self.setPos(page.origin)
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption) # Fills in option.exposedRect
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemClipsChildrenToShape) # Annotations are cut off at the page edge, as in the tiles
+
+    def boundingRect(self) -> QRectF:
+        return QRectF(QPointF(), self.page.size)
+
+    def paint(self, painter: QPainter, option: QStyleOptionGraphicsItem, widget: QWidget | None = None):
+        area = self.area
+        exposed = option.exposedRect
+        painter.fillRect(exposed, area.background_color)
+        if area.renderer is None:
+            return
+
+        bucket = zoom_bucket(QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform()))
+        zoom = bucket_zoom(bucket)
+        raster = QRectF(exposed.topLeft() * zoom, exposed.size() * zoom)
+        for key in area.tiles.visible(self.page.num, bucket, self.page.size, raster):
+            clip = area.tiles.page_rect(key, self.page.size)
+            content = area.page_content(key, clip)
+            area.wait_for_content((key, None, clip, content))
+            if content is not None and content[0] is not None:
+                painter.drawImage(clip, content[0], content[1])
+
+class StrokeItem(QGraphicsItem):
+    def __init__(self, stroke: Stroke, parent: PageItem):
+        super().__init__(parent)
+        self.object = stroke
+        self.setCacheMode(QGraphicsItem.CacheMode.DeviceCoordinateCache)
+
+        margin = stroke.width + ITEM_MARGIN
+        self.rect = QRectF(*stroke.rect).adjusted(-margin, -margin, margin, margin)
+
+    def boundingRect(self) -> QRectF:
+        return self.rect
+
+    def paint(self, painter: QPainter, option: QStyleOptionGraphicsItem, widget: QWidget | None = None):
+        # Stroke.draw() scales the painter itself and picks the level of detail from the zoom
+        zoom = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        painter.scale(1 / zoom, 1 / zoom)
+        self.object.draw(painter, zoom=zoom)
+
+class ShapeItem(QGraphicsItem):
+    # Square, FreeText or Line, which draw at zoom 1 under the view's scale
+    def __init__(self, object: Square | FreeText | Line, parent: PageItem):
+        super().__init__(parent)
+        self.object = object
+        self.setCacheMode(QGraphicsItem.CacheMode.DeviceCoordinateCache)
+        self.setZValue(SHAPE_Z)
+        self.rect = shape_rect(object)
+
+    def boundingRect(self) -> QRectF:
+        return self.rect
+
+    def paint(self, painter: QPainter, option: QStyleOptionGraphicsItem, widget: QWidget | None = None):
+        self.object.draw(painter, zoom=1)
+
+def shape_rect(object: Square | FreeText | Line) -> QRectF:
+    # Page area a shape draws over
+    match object:
+        case Square():
+            margin = object.border_width + ITEM_MARGIN
+            return QRectF(*object.pos, *object.size).adjusted(-margin, -margin, margin, margin)
+        case FreeText():
+            # The text is drawn from its baseline at pos, at a point size of the height
+            font = QFont(object.text_font)
+            font.setPointSizeF(max(1, object.size[1]))
+            rect = QFontMetricsF(font).boundingRect(object.text).translated(*object.pos)
+            return rect.adjusted(-ITEM_MARGIN, -ITEM_MARGIN, ITEM_MARGIN, ITEM_MARGIN)
+        case Line():
+            margin = object.width + ITEM_MARGIN
+            return QRectF(QPointF(*object.p1), QPointF(*object.p2)).normalized().adjusted(-margin, -margin, margin, margin)
+    return QRectF()
+
+def annotation_item(object, page: Page, parent: PageItem) -> QGraphicsItem | None:
+    if isinstance(object, Stroke):
+        item = StrokeItem(object, parent)
+        item.setZValue(page.index.order[object])
+        return item
+    if isinstance(object, (Square, FreeText, Line)):
+        return ShapeItem(object, parent)
+    return None
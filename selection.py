@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+from PyQt6.QtGui import *
+from PyQt6.QtCore import *
+
+from math import sqrt
+
+from classes import Stroke, points_in_polygon, PAINT_MARGIN
+from pages import Page
+from lazy import lazy_import
+np = lazy_import("numpy")
+
+LASSO_COVERAGE = 0.8 # Fraction of a stroke's points that must be inside the lasso for it to be selected
+MIN_SCALE = 0.05 # Smallest a selection can be scaled down to
+RENDER_MARGIN = 0.25 # Fraction of the visible area rendered past each side of it, so that short drags reuse the image
+MAX_IMAGE_PIXELS = 4096 * 4096 # Largest selection image, above which it is rendered at a lower zoom and stretched
+
+def lasso_strokes(page: Page, lasso: list[QPointF]) -> list[Stroke]:
+    # Strokes of a page inside a lasso in page coordinates, in drawing order. The spatial index and the stroke
+    # bounding boxes narrow it down to the strokes near the lasso, whose points are then tested all at once.
+    if len(lasso) < 3:
+        return []
+
+    bounds = QPolygonF(lasso).boundingRect()
+    candidates = [stroke for stroke in page.index.query(bounds) if len(stroke.points) > 0 and
+                  stroke.left <= bounds.right() and stroke.right >= bounds.left() and
+                  stroke.top <= bounds.bottom() and stroke.bottom >= bounds.top()]
+    if len(candidates) == 0:
+        return []
+
+    counts = np.array([len(stroke.points) for stroke in candidates])
+    polygon = np.array([(point.x(), point.y()) for point in lasso])
+    inside = points_in_polygon(np.concatenate([stroke.points for stroke in candidates]), polygon)
+    hits = np.add.reduceat(inside, np.cumsum(counts) - counts)
+    return [stroke for stroke, hit, count in zip(candidates, hits.tolist(), counts.tolist()) if hit >= LASSO_COVERAGE * count]
+
+class Selection:
+    # Strokes picked with the lasso. They are taken out of their page's index, so tiles no longer draw them,
+    # and are drawn over the tiles instead, from an image of the part of them on screen. Moving, scaling and
+    # recolouring only change the transform and colour, which are applied when the image is drawn, so dragging any
+    # number of strokes costs one image per frame. The points are only rewritten by bake(), when the selection is
+    # let go.
+    def __init__(self, page: Page, strokes: list[Stroke]):
+        self.page = page
+        self.strokes = strokes
+        self.order: dict[Stroke, int] = {} # Drawing position of each stroke in the page's index
+
+        self.transform = QTransform() # Uniform scale and translation, in page coordinates
+        self.color: tuple | None = None # Replaces the colour of every stroke
+
+        # Page area the strokes draw over, before the transform
+        self.bounds = QRectF()
+        for stroke in strokes:
+            self.bounds |= QRectF(*stroke.rect).adjusted(-stroke.width, -stroke.width, stroke.width, stroke.width)
+
+        # Rendering of the visible strokes, with the transform it was rendered at and the page area it covers then
+        self.image: QImage | None = None
+        self.image_zoom = 0
+        self.image_transform = QTransform()
+        self.image_rect = QRectF()
+
+    @property
+    def rect(self) -> QRectF:
+        # Page area the transformed strokes draw over
+        return self.transform.mapRect(self.bounds)
+
+    @property
+    def scale(self) -> float:
+        return self.transform.m11()
+
+    @property
+    def changed(self) -> bool:
+        return not self.transform.isIdentity() or self.color is not None
+
+    def translate(self, delta: QPointF):
+        self.transform *= QTransform.fromTranslate(delta.x(), delta.y())
+
+    def scale_by(self, factor: float, anchor: QPointF):
+        # Scale about a point in page coordinates, such as a corner of the selection
+        factor = max(factor, MIN_SCALE / self.scale)
+        self.transform *= QTransform.fromTranslate(-anchor.x(), -anchor.y()) * QTransform.fromScale(factor, factor) * \
+            QTransform.fromTranslate(anchor.x(), anchor.y())
+
+    def recolor(self, color: tuple):
+        self.color = color
+        self.image = None
+
+    def invalidate(self):
+        # Render again on the next draw, such as after scaling, which only stretches the image
+        self.image = None
+
+    def render(self, zoom: float, visible: QRectF):
+        # Render the part of the selection in visible, a page rect, and a margin around it. An image that would
+        # still be too large, such as of a whole page zoomed far in on a large screen, is rendered at a lower zoom.
+        dx, dy = visible.width() * RENDER_MARGIN, visible.height() * RENDER_MARGIN
+        area = self.rect.intersected(visible.adjusted(-dx, -dy, dx, dy))
+        pixels = area.width() * area.height() * zoom * zoom
+        render_zoom = zoom if pixels <= MAX_IMAGE_PIXELS else zoom * sqrt(MAX_IMAGE_PIXELS / pixels)
+
+        rect = QRectF(area.topLeft() * render_zoom, area.size() * render_zoom).toAlignedRect()
+        image = QImage(rect.size(), QImage.Format.Format_ARGB32_Premultiplied)
+        image.fill(Qt.GlobalColor.transparent)
+
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.translate(-rect.topLeft().toPointF() + QPointF(self.transform.dx(), self.transform.dy()) * render_zoom)
+
+        # Strokes outside the area are skipped, testing them before the transform
+        untransformed = self.transform.inverted()[0].mapRect(area)
+        margin = PAINT_MARGIN / (render_zoom * self.scale)
+        for stroke in self.strokes:
+            if stroke.intersects_painted(untransformed, margin):
+                stroke.draw(painter, zoom=render_zoom * self.scale, color=self.color)
+        painter.end()
+
+        self.image = image
+        self.image_zoom = zoom
+        self.image_transform = QTransform(self.transform)
+        self.image_rect = QRectF(QPointF(rect.topLeft()) / render_zoom, QSizeF(rect.size()) / render_zoom)
+
+    def draw(self, painter: QPainter, origin: QPointF, zoom: float, raster_zoom: float, visible: QRectF):
+        # Draw onto the viewport, with origin the top left of the page in it and visible the page rect on screen.
+        # The image is rendered at the zoom of the tiles, and moved and stretched by how the transform changed
+        # since it was rendered. It is rendered again once it no longer covers the visible part of the selection.
+        delta = self.image_transform.inverted()[0] * self.transform
+        shown = self.rect.intersected(visible)
+        if shown.isEmpty():
+            return
+        if self.image is None or self.image_zoom != raster_zoom or \
+                not self.image_rect.contains(delta.inverted()[0].mapRect(shown).adjusted(1e-3, 1e-3, -1e-3, -1e-3)):
+            self.render(raster_zoom, visible)
+            delta = QTransform()
+
+        rect = delta.mapRect(self.image_rect)
+        target = QRectF(origin + rect.topLeft() * zoom, rect.size() * zoom)
+        painter.drawImage(target, self.image, QRectF(self.image.rect()))
+
+    def bake(self) -> list[tuple[Stroke, Stroke]]:
+        # New strokes with the transform and colour applied, paired with the strokes they replace and keeping
+        # their ids. The points of every stroke are transformed in one operation.
+        transform = self.transform
+        matrix = np.array([[transform.m11(), transform.m12()], [transform.m21(), transform.m22()]])
+        offset = np.array([transform.dx(), transform.dy()])
+
+        counts = [len(stroke.points) for stroke in self.strokes]
+        points = np.concatenate([stroke.points for stroke in self.strokes]).astype(np.float64) @ matrix + offset
+        points = np.split(points.astype(np.float32), np.cumsum(counts)[:-1])
+
+        pairs = []
+        for stroke, stroke_points in zip(self.strokes, points):
+            color = stroke.color if self.color is None else self.color
+            pairs.append((stroke, Stroke(color, stroke.width * self.scale, stroke_points, stroke.opacity, stroke.highlight,
+                                         id=stroke.id)))
+        return pairs
@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import os
+import sys
+import json
+import hashlib
+import subprocess
+
+from classes import Ink
+from lazy import lazy_import
+np = lazy_import("numpy")
+
+# Parsed annotations are cached per document, so unchanged files open without parsing them again.
+# PDFEDITOR_CACHE sets the cache directory, or turns the cache off with 0.
+SETTING = os.environ.get("PDFEDITOR_CACHE", "")
+ENABLED = SETTING != "0"
+DIRECTORY = SETTING or os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "pdfeditor")
+
+MAGIC = b"PDFEDCA1"
+VERSION = 1
+QUANTUM = 100 # Points are stored in units of 1 / QUANTUM page points
+ALIGNMENT = 8 # The point data starts at a multiple of this many bytes, so it can be memory-mapped
+
+# A cache file is MAGIC, the header length as 4 bytes, a JSON header, padding, then the points of every
+# stroke: each stroke's first point is in the header, and the rest are the differences between successive
+# points, quantised to integers. Those are small enough for int16 unless a file has very long jumps.
+
+def cache_path(filename: str) -> str:
+    # One cache file per document path
+    name = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+    return os.path.join(DIRECTORY, name + ".annots")
+
+def file_key(filename: str) -> dict:
+    # What must not have changed since the cache was written
+    stat = os.stat(filename)
+    digest = hashlib.blake2b()
+    with open(filename, "rb") as file:
+        while chunk := file.read(1 << 20):
+            digest.update(chunk)
+    return {"path": os.path.abspath(filename), "size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest.hexdigest()}
+
+class CachedDocument:
+    def __init__(self, header: dict, deltas: np.ndarray):
+        self.sizes = header["sizes"]
+        self.renamed = [tuple(pair) for pair in header["renamed"]] # (xref, id) of annotations given an id when parsed
+        self.pages = header["pages"]
+        self.deltas = deltas # Memory-mapped, only the pages that are read are loaded from disk
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def page(self, page_num: int) -> list:
+        objects = []
+        for obj_id, color, width, opacity, start, offset, count in self.pages[page_num]:
+            if count == 0:
+                points = np.empty((0, 2), dtype=np.float32)
+            else:
+                quantised = np.empty((count, 2), dtype=np.int64)
+                quantised[0] = start
+                quantised[1:] = self.deltas[offset:offset + count - 1]
+                points = (np.cumsum(quantised, axis=0) / QUANTUM).astype(np.float32)
+
+            ink = Ink(id=obj_id, points=points, color=(0, 0, 0), width=width, opacity=opacity)
+            ink.color = color # Already converted to 0-255 when the file was parsed
+            objects.append(ink)
+        return objects
+
+def load(filename: str, simplify: bool) -> CachedDocument | None:
+    # The cached annotations of a document, or None when there are none or the document has changed
+    # A truncated or corrupt cache file is ignored, and the document is parsed instead
+    path = cache_path(filename)
+    try:
+        with open(path, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                return None
+            length = int.from_bytes(file.read(4), "little")
+            header = json.loads(file.read(length))
+
+        if header.get("version") != VERSION or header["simplify"] != simplify:
+            return None
+
+        # Cheap checks first, hashing reads the whole document
+        stat = os.stat(filename)
+        if header["path"] != os.path.abspath(filename) or header["size"] != stat.st_size or header["mtime"] != stat.st_mtime_ns:
+            return None
+        if header["hash"] != file_key(filename)["hash"]:
+            return None
+
+        if header["count"] == 0:
+            deltas = np.empty((0, 2), dtype=header["dtype"])
+        else:
+            deltas = np.memmap(path, dtype=header["dtype"], mode="r", offset=header["offset"], shape=(header["count"], 2))
+        return CachedDocument(header, deltas)
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+def write(filename: str, key: dict, simplify: bool, sizes: list, pages: list[list], renamed: list[tuple[int, str]]):
+    # key is file_key() from before the document was parsed, so changes made meanwhile invalidate the cache
+    records = []
+    deltas = []
+    offset = 0
+    for objects in pages:
+        page_records = []
+        for object in objects:
+            if not isinstance(object, Ink):
+                continue
+
+            quantised = np.round(object.points.astype(np.float64) * QUANTUM).astype(np.int64)
+            start = quantised[0].tolist() if len(quantised) else [0, 0]
+            if len(quantised) > 1:
+                deltas.append(np.diff(quantised, axis=0))
+            page_records.append([str(object.id), list(object.color), object.width, object.opacity, start, offset, len(quantised)])
+            offset += max(0, len(quantised) - 1)
+        records.append(page_records)
+
+    deltas = np.concatenate(deltas) if deltas else np.empty((0, 2), dtype=np.int64)
+    dtype = "<i2" if len(deltas) == 0 or np.abs(deltas).max() < 2 ** 15 else "<i4"
+
+    header = {"version": VERSION, **key, "simplify": simplify, "dtype": dtype, "count": len(deltas),
+              "sizes": sizes, "renamed": renamed, "pages": records}
+    # The offset of the point data depends on the header length, which depends on the offset
+    header["offset"] = 0
+    while True:
+        text = json.dumps(header, separators=(",", ":")).encode()
+        data_offset = -(-(len(MAGIC) + 4 + len(text)) // ALIGNMENT) * ALIGNMENT
+        if header["offset"] == data_offset:
+            break
+        header["offset"] = data_offset
+
+    # Written next to the cache file and swapped in, so readers never see a partial file
+    os.makedirs(DIRECTORY, exist_ok=True)
+    path = cache_path(filename)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(MAGIC)
+        file.write(len(text).to_bytes(4, "little"))
+        file.write(text)
+        file.write(b"\0" * (data_offset - len(MAGIC) - 4 - len(text)))
+        file.write(deltas.astype(dtype).tobytes())
+    os.replace(temp_path, path)
+
+def build_in_background(filename: str):
+    # Parse the whole document in a separate process, which outlives the editor if it is closed first
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), filename],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+if __name__ == "__main__":
+    from reader import Reader
+
+    # Build the caches of the given documents
+    for filename in sys.argv[1:]:
+        reader = Reader(filename)
+        if reader.cache is None:
+            reader.write_cache()
+        reader.close()
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+from PyQt6.QtCore import *
+
+from math import floor
+
+from lazy import lazy_import
+np = lazy_import("numpy")
+
+CELL_SIZE = 32 # Size of a grid cell in page coordinates
+
+class StrokeIndex:
+    # Uniform grid over the bounding boxes of every stroke segment, padded by the pen width so that a query
+    # finds every stroke that paints in its rect. Each cell maps the strokes passing through it to the indices
+    # of their segments in that cell. Filled strokes also cover every cell of their bounding box.
+    def __init__(self, cell_size: float = CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells: dict[tuple[int, int], dict[object, list[int]]] = {}
+        self.stroke_cells: dict[object, list[tuple[int, int]]] = {}
+
+        # Insertion order, used to return strokes in drawing order
+        self.order: dict[object, int] = {}
+        self.counter = 0
+
+    def __len__(self) -> int:
+        return len(self.stroke_cells)
+
+    def __contains__(self, stroke) -> bool:
+        return stroke in self.stroke_cells
+
+    def cell_range(self, left: float, top: float, right: float, bottom: float):
+        size = self.cell_size
+        for cy in range(floor(top / size), floor(bottom / size) + 1):
+            for cx in range(floor(left / size), floor(right / size) + 1):
+                yield cx, cy
+
+    def insert(self, stroke, order: int | None = None):
+        # order puts a stroke back at the drawing position it was removed from
+        if stroke in self.stroke_cells:
+            self.remove(stroke)
+
+        cells = {}
+        segments = stroke.segments
+        pad = stroke.width
+        if len(segments) == 0 or stroke.highlight:
+            # A single point has no segments, and a filled stroke paints between them, so index its bounding box
+            for cell in self.cell_range(stroke.left - pad, stroke.top - pad, stroke.right + pad, stroke.bottom + pad):
+                cells.setdefault(cell, [])
+
+        # Cell range of every segment's bounding box grown by the pen, computed in bulk
+        x1, y1, x2, y2 = segments.T
+        ranges = np.floor(np.stack((np.minimum(x1, x2) - pad, np.minimum(y1, y2) - pad,
+                                    np.maximum(x1, x2) + pad, np.maximum(y1, y2) + pad), axis=1) / self.cell_size)
+
+        for i, (left, top, right, bottom) in enumerate(ranges.astype(np.int64).tolist()):
+            for cy in range(top, bottom + 1):
+                for cx in range(left, right + 1):
+                    cells.setdefault((cx, cy), []).append(i)
+
+        for cell, segments in cells.items():
+            self.cells.setdefault(cell, {})[stroke] = segments
+
+        self.stroke_cells[stroke] = list(cells)
+        if order is None:
+            order = self.counter
+            self.counter += 1
+        self.order[stroke] = order
+
+    def remove(self, stroke) -> int | None:
+        # Returns the drawing position of the stroke
+        cells = self.stroke_cells.pop(stroke, None)
+        if cells is None:
+            return None
+
+        for cell in cells:
+            bucket = self.cells[cell]
+            del bucket[stroke]
+            if len(bucket) == 0:
+                del self.cells[cell]
+
+        return self.order.pop(stroke)
+
+    def clear(self):
+        self.cells.clear()
+        self.stroke_cells.clear()
+        self.order.clear()
+
+    def buckets(self, rect: QRectF):
+        left, top = floor(rect.left() / self.cell_size), floor(rect.top() / self.cell_size)
+        right, bottom = floor(rect.right() / self.cell_size), floor(rect.bottom() / self.cell_size)
+
+        # Large query rects scan the occupied cells instead of every cell they cover
+        if (right - left + 1) * (bottom - top + 1) > len(self.cells):
+            for (cx, cy), bucket in self.cells.items():
+                if left <= cx <= right and top <= cy <= bottom:
+                    yield bucket
+            return
+
+        for cy in range(top, bottom + 1):
+            for cx in range(left, right + 1):
+                bucket = self.cells.get((cx, cy))
+                if bucket is not None:
+                    yield bucket
+
+    def segments(self, rect: QRectF) -> dict[object, list[int]]:
+        # Strokes with a segment box in a cell overlapping rect, mapped to those segments' indices
+        found: dict[object, set[int]] = {}
+        for bucket in self.buckets(rect):
+            for stroke, segments in bucket.items():
+                found.setdefault(stroke, set()).update(segments)
+
+        return {stroke: sorted(segments) for stroke, segments in found.items()}
+
+    def query(self, rect: QRectF) -> list:
+        # Strokes that may intersect rect, in the order they were inserted
+        found = set()
+        for bucket in self.buckets(rect):
+            found.update(bucket)
+
+        return sorted(found, key=self.order.__getitem__)
@@ -0,0 +1,122 @@
+class AnnotationStore:
+    # Every loaded annotation, keyed by (page, /NM id), since ids are only unique among the annotations of a page.
+    # Secondary indexes find the annotations of a page, and of a type on a page, and changes made since the file
+    # was read or written are tracked per page, so the pages to save and what to write are known without a scan.
+    def __init__(self):
+        self.annotations: dict[tuple[int, str], object] = {}
+        self.by_page: dict[int, dict[str, object]] = {} # In the order they were added
+        self.by_page_type: dict[tuple[int, type], dict[str, object]] = {}
+
+        # Ids in the file, and the ids added, deleted and updated since, per page
+        self.saved: dict[int, set[str]] = {}
+        self.added: dict[int, set[str]] = {}
+        self.deleted: dict[int, set[str]] = {}
+        self.updated: dict[int, set[str]] = {}
+        self.dirty: set[int] = set() # Pages with unsaved changes
+
+        # Counts tracked changes, and the count at the last change of each annotation,
+        # so that a save can tell which changes were made after it started
+        self.version = 0
+        self.modified: dict[tuple[int, str], int] = {}
+
+    def __len__(self) -> int:
+        return len(self.annotations)
+
+    def __contains__(self, key: tuple[int, str]) -> bool:
+        return key in self.annotations
+
+    def get(self, page_num: int, obj_id: str):
+        return self.annotations.get((page_num, obj_id))
+
+    def page(self, page_num: int, *kinds: type) -> list:
+        # Annotations of a page, optionally only those of the given types
+        if len(kinds) == 0:
+            return list(self.by_page.get(page_num, {}).values())
+        if len(kinds) == 1:
+            return list(self.by_page_type.get((page_num, kinds[0]), {}).values())
+        return [object for kind in kinds for object in self.by_page_type.get((page_num, kind), {}).values()]
+
+    def add(self, page_num: int, object, track: bool = True):
+        # Untracked additions are annotations read from the file
+        obj_id = str(object.id)
+        key = (page_num, obj_id)
+        if key in self.annotations:
+            raise KeyError(f"Page {page_num} already has an annotation with id {obj_id}")
+
+        self.annotations[key] = object
+        self.by_page.setdefault(page_num, {})[obj_id] = object
+        self.by_page_type.setdefault((page_num, type(object)), {})[obj_id] = object
+
+        if track:
+            self.version += 1
+            self.modified[key] = self.version
+            if obj_id in self.saved.get(page_num, ()):
+                self.deleted.get(page_num, set()).discard(obj_id)
+            else:
+                self.added.setdefault(page_num, set()).add(obj_id)
+            self.update_dirty(page_num)
+
+    def remove(self, page_num: int, obj_id: str):
+        obj_id = str(obj_id)
+        object = self.annotations.pop((page_num, obj_id))
+        del self.by_page[page_num][obj_id]
+        del self.by_page_type[(page_num, type(object))][obj_id]
+
+        self.version += 1
+        self.modified.pop((page_num, obj_id), None)
+        if obj_id in self.saved.get(page_num, ()):
+            self.deleted.setdefault(page_num, set()).add(obj_id)
+        else:
+            self.added.get(page_num, set()).discard(obj_id)
+        self.update_dirty(page_num)
+
+        return object
+
+    def modify(self, page_num: int, obj_id: str):
+        # Record that an annotation changed, so that it is written again
+        obj_id = str(obj_id)
+        self.version += 1
+        self.modified[(page_num, obj_id)] = self.version
+        if obj_id in self.saved.get(page_num, ()):
+            self.updated.setdefault(page_num, set()).add(obj_id)
+            self.update_dirty(page_num)
+
+    def changes(self, page_num: int) -> tuple[set[str], set[str], set[str]]:
+        # Ids to add to, delete from and replace in the file
+        deleted = self.deleted.get(page_num, set())
+        return set(self.added.get(page_num, ())), set(deleted), self.updated.get(page_num, set()) - deleted
+
+    def update_dirty(self, page_num: int):
+        deleted = self.deleted.get(page_num, set())
+        if self.added.get(page_num) or deleted or not self.updated.get(page_num, set()) <= deleted:
+            self.dirty.add(page_num)
+        else:
+            self.dirty.discard(page_num)
+
+    def mark_saved(self, page_num: int):
+        # The annotations now on the page are the ones in the file
+        self.saved[page_num] = set(self.by_page.get(page_num, ()))
+        self.added.pop(page_num, None)
+        self.deleted.pop(page_num, None)
+        self.updated.pop(page_num, None)
+        self.dirty.discard(page_num)
+        for obj_id in self.saved[page_num]:
+            self.modified.pop((page_num, obj_id), None)
+
+    def mark_written(self, page_num: int, obj_ids: set[str], version: int):
+        # A save of the page as it was at version finished, and obj_ids are the annotations now in the file.
+        # Changes made after version are still unsaved.
+        present = set(self.by_page.get(page_num, ()))
+        self.saved[page_num] = set(obj_ids)
+        self.added[page_num] = present - obj_ids
+        self.deleted[page_num] = obj_ids - present
+        self.updated[page_num] = {obj_id for obj_id in present & obj_ids if self.modified.get((page_num, obj_id), 0) > version}
+        for obj_id in present - self.updated[page_num]:
+            self.modified.pop((page_num, obj_id), None)
+        self.update_dirty(page_num)
+
+    def unload(self, page_num: int):
+        # Forget the annotations of a page without unsaved changes. It can be read from the file again.
+        for obj_id, object in self.by_page.pop(page_num, {}).items():
+            del self.annotations[(page_num, obj_id)]
+            self.by_page_type.pop((page_num, type(object)), None)
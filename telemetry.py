@@ -0,0 +1,125 @@
+from PyQt6.QtCore import *
+
+import os
+import json
+import atexit
+from math import frexp
+from time import perf_counter
+from functools import wraps
+
+# Opt-in with PDFEDITOR_TELEMETRY=1, or set it to the file the measurements are written to on exit.
+# When it is not set, timed() returns functions unchanged, so there is no cost at all.
+SETTING = os.environ.get("PDFEDITOR_TELEMETRY", "")
+ENABLED = SETTING not in ("", "0")
+DUMP_FILENAME = "telemetry.json" if SETTING in ("", "0", "1") else SETTING
+
+BUCKETS = 32 # Histogram buckets, doubling in width from 1 microsecond
+LAG_INTERVAL = 50 # Milliseconds between event loop lag probes
+FRAME_GAP = 1 # Seconds between frames after which the next frame starts a new burst, not a slow frame
+
+class Histogram:
+    # Durations in buckets of exponentially increasing width, so recording is O(1) and the size is fixed
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, seconds: float):
+        bucket = frexp(seconds * 1e6)[1] if seconds > 0 else 0
+        self.counts[min(BUCKETS - 1, max(0, bucket))] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction: float) -> float:
+        # Upper bound of the bucket holding the percentile, in seconds
+        target = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count > 0 and seen >= target:
+                return min(self.max, 2 ** bucket / 1e6)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "buckets": {f"<{2 ** bucket}us": count for bucket, count in enumerate(self.counts) if count},
+        }
+
+histograms: dict[str, Histogram] = {}
+last_frame = None
+
+def record(name: str, seconds: float):
+    histogram = histograms.get(name)
+    if histogram is None:
+        histogram = histograms[name] = Histogram()
+    histogram.add(seconds)
+
+def timed(name: str):
+    # Decorator recording the latency of every call under name
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, perf_counter() - start)
+        return wrapper
+    return decorator
+
+def frame():
+    # Called once per painted frame, records the time since the previous one
+    global last_frame
+    now = perf_counter()
+    if last_frame is not None and now - last_frame < FRAME_GAP:
+        record("frame interval", now - last_frame)
+    last_frame = now
+
+def summary() -> dict:
+    return {name: histogram.summary() for name, histogram in sorted(histograms.items())}
+
+def dump(filename: str = DUMP_FILENAME):
+    with open(filename, "w") as file:
+        json.dump(summary(), file, indent=2)
+
+def report() -> list[str]:
+    # One line per measurement, for the debug overlay
+    lines = []
+    for name, histogram in sorted(histograms.items()):
+        lines.append(f"{name:<16} n={histogram.count:<6} p50={histogram.percentile(0.5) * 1000:6.2f}ms "
+                     f"p95={histogram.percentile(0.95) * 1000:6.2f}ms max={histogram.max * 1000:7.2f}ms")
+    return lines
+
+class LagMonitor(QObject):
+    # Measures how late a periodic timer fires, which is how long events wait in the queue
+    def __init__(self, parent: QObject | None = None, interval: int = LAG_INTERVAL):
+        super().__init__(parent)
+        self.interval = interval
+        self.expected = None
+
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.timer.timeout.connect(self.tick)
+
+    def start(self):
+        self.expected = perf_counter() + self.interval / 1000
+        self.timer.start(self.interval)
+
+    def tick(self):
+        now = perf_counter()
+        record("event loop lag", max(0, now - self.expected))
+        self.expected = now + self.interval / 1000
+
+if ENABLED:
+    atexit.register(dump)
@@ -0,0 +1,83 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pymupdf
+import pytest
+from PyQt6.QtCore import QPointF
+
+from autosave import Autosaver
+from classes import Stroke
+from reader import Reader
+from store import AnnotationStore
+
+@pytest.fixture
+def autosaver(tmp_path):
+    # Autosaver of an empty one page document
+    filename = str(tmp_path / "document.pdf")
+    doc = pymupdf.open()
+    doc.new_page()
+    doc.save(filename)
+    doc.close()
+
+    autosaver = Autosaver(Reader(filename, use_cache=False), AnnotationStore())
+    yield autosaver
+    autosaver.close()
+    autosaver.reader.close()
+
+def die(*args):
+    os._exit(1)
+
+def annotations(filename: str) -> int:
+    doc = pymupdf.open(filename)
+    try:
+        return len(list(doc[0].annots()))
+    finally:
+        doc.close()
+
+def test_save(autosaver):
+    autosaver.store.add(0, Stroke((255, 0, 0), 2, [QPointF(10, 10), QPointF(50, 60)]))
+    autosaver.save()
+    autosaver.wait()
+    assert autosaver.store.dirty == set()
+    assert annotations(autosaver.reader.filename) == 1
+
+def test_dead_worker_fails_one_save(autosaver):
+    errors = []
+    autosaver.failed.connect(errors.append)
+
+    # A worker that dies breaks its executor
+    autosaver.executor = ProcessPoolExecutor(1)
+    with pytest.raises(BrokenProcessPool):
+        autosaver.executor.submit(os._exit, 1).result()
+
+    autosaver.store.add(0, Stroke((255, 0, 0), 2, [QPointF(10, 10), QPointF(50, 60)]))
+    autosaver.save()
+    assert len(errors) == 1 and errors[0].startswith("BrokenProcessPool")
+    assert autosaver.store.dirty == {0}
+
+    # The next save runs in a new worker
+    autosaver.save()
+    autosaver.wait()
+    assert len(errors) == 1
+    assert autosaver.store.dirty == set()
+    assert annotations(autosaver.reader.filename) == 1
+
+def test_worker_dying_during_save(autosaver, monkeypatch):
+    errors = []
+    autosaver.failed.connect(errors.append)
+    size = os.path.getsize(autosaver.reader.filename)
+
+    monkeypatch.setattr("autosave.write", die)
+    autosaver.store.add(0, Stroke((255, 0, 0), 2, [QPointF(10, 10), QPointF(50, 60)]))
+    autosaver.save()
+    autosaver.wait()
+    assert len(errors) == 1 and errors[0].startswith("BrokenProcessPool")
+    assert os.path.getsize(autosaver.reader.filename) == size
+
+    # Only the save that was running fails
+    monkeypatch.undo()
+    autosaver.save()
+    autosaver.wait()
+    assert len(errors) == 1
+    assert annotations(autosaver.reader.filename) == 1
@@ -0,0 +1,61 @@
+import random
+
+from PyQt6.QtCore import QPointF, QRectF, Qt
+from PyQt6.QtGui import QColor, QImage, QPainter
+
+from classes import Stroke, PAINT_MARGIN
+from spatial import StrokeIndex
+
+TILE = 16 # Size of the test tiles in page coordinates
+ZOOM = 4
+
+# A tile must draw every stroke that paints inside it, so compare the culling with what is actually painted
+
+def painted(stroke: Stroke, rect: QRectF) -> bool:
+    # Whether drawing the stroke changes any pixel of rect at ZOOM
+    size = rect.size().toSize() * ZOOM
+    image = QImage(size, QImage.Format.Format_ARGB32)
+    image.fill(Qt.GlobalColor.transparent)
+    painter = QPainter(image)
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+    painter.translate(-rect.topLeft() * ZOOM)
+    stroke.draw(painter, zoom=ZOOM)
+    painter.end()
+    return any(QColor.fromRgba(image.pixel(x, y)).alpha() > 0 for y in range(size.height()) for x in range(size.width()))
+
+def test_thick_stroke_past_tile_edge():
+    # Centre line just below the tile, pen reaching into it
+    stroke = Stroke((0, 0, 0), 6, [QPointF(0, TILE + 1.5), QPointF(TILE, TILE + 1.5)])
+    tile = QRectF(0, 0, TILE, TILE)
+    assert not stroke.colliderect(tile)
+    assert stroke.intersects_painted(tile, PAINT_MARGIN / ZOOM)
+
+    index = StrokeIndex(cell_size=TILE)
+    index.insert(stroke)
+    assert index.query(tile) == [stroke]
+
+def test_tile_inside_highlight():
+    # A highlight much larger than the tile, which none of its edges cross
+    highlight = Stroke((255, 255, 0), 0, [QPointF(-100, -100), QPointF(100, -100), QPointF(100, 100), QPointF(-100, 100)],
+                       highlight=True)
+    tile = QRectF(0, 0, TILE, TILE)
+    assert not highlight.colliderect(tile)
+    assert highlight.intersects_painted(tile)
+
+    index = StrokeIndex(cell_size=TILE)
+    index.insert(highlight)
+    assert index.query(tile) == [highlight]
+
+def test_culling_keeps_painted_strokes():
+    rng = random.Random(0)
+    for n in range(200):
+        highlight = n % 2 == 1
+        points = [QPointF(rng.uniform(-24, 40), rng.uniform(-24, 40)) for _ in range(rng.randint(2, 8))]
+        stroke = Stroke((0, 0, 0), 0 if highlight else rng.uniform(0.5, 8), points, highlight=highlight)
+        index = StrokeIndex(cell_size=TILE)
+        index.insert(stroke)
+
+        tile = QRectF(0, 0, TILE, TILE)
+        if painted(stroke, tile):
+            assert stroke.intersects_painted(tile, PAINT_MARGIN / ZOOM)
+            assert index.query(tile) == [stroke]
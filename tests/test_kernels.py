@@ -0,0 +1,78 @@
+import random
+
+import numpy as np
+import pytest
+from PyQt6.QtCore import QPointF, QLineF, QRectF, Qt
+from PyQt6.QtGui import QPolygonF
+
+from classes import (Stroke, colliderect, intersect_lines, intersect_line_rect, line_array, intersect_lines_segments,
+                     intersect_rect_segments, collidepoint_segments, collideline_strokes, points_in_polygon)
+
+CASES = 2000 # Random cases per test, half of them on a coarse grid
+
+# The batched collision tests must give exactly the same results as the scalar ones
+
+def random_point(rng: random.Random, grid: bool) -> QPointF:
+    # Snapping to a coarse grid produces parallel, collinear and touching segments
+    if grid:
+        return QPointF(rng.randint(-3, 3) * 10, rng.randint(-3, 3) * 10)
+    return QPointF(rng.uniform(-50, 50), rng.uniform(-50, 50))
+
+def random_cases():
+    # (grid, stroke, its segments as QLineFs, line, rect, point) for each case
+    rng = random.Random(0)
+    for n in range(CASES):
+        grid = n % 2 == 0
+        stroke = Stroke((0, 0, 0), 1, [random_point(rng, grid) for _ in range(rng.randint(1, 12))])
+        points = [QPointF(x, y) for x, y in stroke.points.astype(np.float64).tolist()]
+        pairs = [QLineF(points[i], points[i + 1]) for i in range(len(points) - 1)]
+        line = QLineF(random_point(rng, grid), random_point(rng, grid))
+        rect = QRectF(random_point(rng, grid), random_point(rng, grid)).normalized()
+        yield grid, stroke, pairs, line, rect, random_point(rng, grid)
+
+@pytest.fixture(scope="module")
+def cases() -> list[tuple]:
+    return list(random_cases())
+
+def test_intersect_lines_segments(cases):
+    for _, stroke, pairs, line, _, _ in cases:
+        expected = [intersect_lines(line, pair) for pair in pairs]
+        assert intersect_lines_segments(line_array(line), stroke.segments).tolist() == expected
+
+def test_intersect_rect_segments(cases):
+    for _, stroke, pairs, _, rect, _ in cases:
+        expected = [intersect_line_rect(pair, rect) for pair in pairs]
+        assert intersect_rect_segments(stroke.segments, rect).tolist() == expected
+
+def test_colliderect(cases):
+    for _, stroke, pairs, _, rect, _ in cases:
+        expected = stroke.left <= rect.right() and stroke.right >= rect.left() and \
+            stroke.top <= rect.bottom() and stroke.bottom >= rect.top() and any(intersect_line_rect(pair, rect) for pair in pairs)
+        assert stroke.colliderect(rect) == expected
+
+def test_collidepoint_segments(cases):
+    for _, stroke, pairs, _, _, pos in cases:
+        expected = [colliderect(pair.p1(), pair.p2(), pos) for pair in pairs]
+        assert collidepoint_segments(stroke.segments, pos.x(), pos.y()).tolist() == expected
+
+def test_collideline(cases):
+    for _, stroke, pairs, line, _, _ in cases:
+        expected = intersect_line_rect(line, QRectF(*stroke.rect)) and any(intersect_lines(line, pair) for pair in pairs)
+        assert stroke.collideline(line) == expected
+        assert (collideline_strokes([stroke], line) == [stroke]) == expected
+
+def test_collidepoint(cases):
+    for _, stroke, pairs, _, _, pos in cases:
+        expected = stroke.left <= pos.x() <= stroke.right and stroke.top <= pos.y() <= stroke.bottom and \
+            any(colliderect(pair.p1(), pair.p2(), pos) for pair in pairs)
+        assert stroke.collidepoint(pos) == expected
+
+def test_points_in_polygon():
+    # Points on an edge may go either way, so only off-grid points are compared
+    rng = random.Random(0)
+    for _ in range(CASES):
+        polygon = QPolygonF([random_point(rng, False) for _ in range(rng.randint(3, 15))])
+        pos = random_point(rng, False)
+        vertices = np.array([(p.x(), p.y()) for p in polygon])
+        expected = polygon.containsPoint(pos, Qt.FillRule.OddEvenFill)
+        assert points_in_polygon(np.array([(pos.x(), pos.y())]), vertices)[0] == expected
@@ -0,0 +1,48 @@
+import os
+
+import pymupdf
+import pytest
+
+import sidecar
+from reader import Reader
+
+@pytest.fixture
+def document(tmp_path, monkeypatch) -> str:
+    # A page with two ink annotations, and its annotation cache in the temporary directory
+    monkeypatch.setattr(sidecar, "DIRECTORY", str(tmp_path / "cache"))
+    filename = str(tmp_path / "document.pdf")
+    doc = pymupdf.open()
+    page = doc.new_page()
+    for i in range(2):
+        page.add_ink_annot([[(10 + i, 10), (50, 50 + i), (90, 20)]]).update()
+    doc.save(filename)
+    doc.close()
+
+    reader = Reader(filename, use_cache=False)
+    reader.write_cache()
+    reader.close()
+    return filename
+
+def read(filename: str) -> tuple[bool, int]:
+    # Whether the cache was used, and the number of annotations read
+    reader = Reader(filename, use_cache=True)
+    try:
+        return reader.cache is not None, len(reader.read_page(0))
+    finally:
+        reader.close()
+
+def test_cache_is_used(document):
+    assert read(document) == (True, 2)
+
+def test_truncated_cache_is_ignored(document):
+    path = sidecar.cache_path(document)
+    size = os.path.getsize(path)
+    with open(path, "rb+") as file:
+        file.truncate(size - 4) # Cuts into the point data, which is memory-mapped
+    assert read(document) == (False, 2)
+
+@pytest.mark.parametrize("header", [b"{", b"[]", b'{"version": 1}', b'{"version": 1, "simplify": true, "path": null}'])
+def test_corrupt_header_is_ignored(document, header):
+    with open(sidecar.cache_path(document), "wb") as file:
+        file.write(sidecar.MAGIC + len(header).to_bytes(4, "little") + header)
+    assert read(document) == (False, 2)
@@ -0,0 +1,122 @@
+from PyQt6.QtGui import *
+from PyQt6.QtCore import *
+
+from collections import OrderedDict, Counter
+from math import log2, ceil, floor
+
+TILE_SIZE = 256
+ZOOM_STEPS = 8 # Zoom buckets per doubling of the zoom
+TILE_MEMORY = 128 * 1024 * 1024 # Bytes of tile images kept before the least recently used are evicted
+FALLBACK_BUCKETS = 3 * ZOOM_STEPS # How much coarser cached tiles may be to stand in for a missing tile, here 8 times
+
+def zoom_bucket(zoom: float) -> int:
+    # Round up so tiles are rasterised at least as sharp as they are displayed
+    return ceil(log2(zoom) * ZOOM_STEPS - 1e-9)
+
+def bucket_zoom(bucket: int) -> float:
+    return 2 ** (bucket / ZOOM_STEPS)
+
+class TileCache:
+    def __init__(self, tile_size: int = TILE_SIZE, max_bytes: int = TILE_MEMORY):
+        self.tile_size = tile_size
+        self.max_bytes = max_bytes
+
+        # (page, zoom bucket, tile x, tile y) -> QImage, ordered from least to most recently used
+        self.tiles: OrderedDict[tuple, QImage] = OrderedDict()
+        self.bytes = 0
+        self.counts: Counter[tuple] = Counter() # Tiles cached per (page, zoom bucket)
+
+    def __len__(self) -> int:
+        return len(self.tiles)
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self.tiles
+
+    def get(self, key: tuple) -> QImage | None:
+        image = self.tiles.get(key)
+        if image is not None:
+            self.tiles.move_to_end(key)
+        return image
+
+    def put(self, key: tuple, image: QImage):
+        self.discard(key)
+        self.tiles[key] = image
+        self.bytes += image.sizeInBytes()
+        self.counts[key[:2]] += 1
+
+        # Evict least recently used tiles, but always keep the newest one
+        while self.bytes > self.max_bytes and len(self.tiles) > 1:
+            self.discard(next(iter(self.tiles)))
+
+    def tile_rect(self, key: tuple, page_size: QSizeF) -> QRect:
+        # Rect of a tile in raster pixels, clipped to the edge of the page
+        _, bucket, tx, ty = key
+        zoom = bucket_zoom(bucket)
+        width = ceil(page_size.width() * zoom)
+        height = ceil(page_size.height() * zoom)
+
+        x, y = tx * self.tile_size, ty * self.tile_size
+        return QRect(x, y, min(self.tile_size, width - x), min(self.tile_size, height - y))
+
+    def page_rect(self, key: tuple, page_size: QSizeF) -> QRectF:
+        # Rect of a tile in unzoomed page coordinates
+        zoom = bucket_zoom(key[1])
+        rect = QRectF(self.tile_rect(key, page_size))
+        return QRectF(rect.topLeft() / zoom, rect.size() / zoom)
+
+    def visible(self, page: int, bucket: int, page_size: QSizeF, rect: QRectF) -> list[tuple]:
+        # Keys of all tiles of a page intersecting rect, given in raster pixels
+        zoom = bucket_zoom(bucket)
+        cols = ceil(page_size.width() * zoom / self.tile_size)
+        rows = ceil(page_size.height() * zoom / self.tile_size)
+
+        x0 = max(0, floor(rect.left() / self.tile_size))
+        y0 = max(0, floor(rect.top() / self.tile_size))
+        x1 = min(cols - 1, floor(rect.right() / self.tile_size))
+        y1 = min(rows - 1, floor(rect.bottom() / self.tile_size))
+
+        return [(page, bucket, tx, ty) for ty in range(y0, y1 + 1) for tx in range(x0, x1 + 1)]
+
+    def coarser(self, page: int, bucket: int, rect: QRectF, page_size: QSizeF) -> list[tuple] | None:
+        # Keys of the cached tiles of the closest coarser bucket that together cover rect, given in page coordinates
+        for coarse in range(bucket - 1, bucket - FALLBACK_BUCKETS - 1, -1):
+            if self.counts[(page, coarse)] == 0:
+                continue
+            zoom = bucket_zoom(coarse)
+            keys = self.visible(page, coarse, page_size, QRectF(rect.topLeft() * zoom, rect.size() * zoom))
+            if all(key in self.tiles for key in keys):
+                return keys
+        return None
+
+    def discard(self, key: tuple):
+        image = self.tiles.pop(key, None)
+        if image is not None:
+            self.bytes -= image.sizeInBytes()
+            self.counts[key[:2]] -= 1
+
+    def invalidate(self, page: int | None = None, rect: QRectF | None = None,
+                   page_size: QSizeF | None = None, keep_bucket: int | None = None):
+        # Drop tiles of a page (or all pages) that intersect rect, given in page coordinates
+        for key in list(self.tiles):
+            if page is not None and key[0] != page:
+                continue
+            if keep_bucket is not None and key[1] == keep_bucket:
+                continue
+            if rect is not None and not self.page_rect(key, page_size).intersects(rect):
+                continue
+
+            self.discard(key)
+
+    def invalidate_rects(self, page: int, rects: list[QRectF], page_size: QSizeF):
+        # invalidate() for many rects of a page at once, looking up the tiles under each rect
+        # rather than testing every cached tile against every rect
+        for bucket in {key[1] for key in self.tiles if key[0] == page}:
+            zoom = bucket_zoom(bucket)
+            for rect in rects:
+                for key in self.visible(page, bucket, page_size, QRectF(rect.topLeft() * zoom, rect.size() * zoom)):
+                    self.discard(key)
+
+    def clear(self):
+        self.tiles.clear()
+        self.bytes = 0
+        self.counts.clear()